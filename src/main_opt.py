@@ -16,6 +16,7 @@ from config import Config, Presets
 from trset import TrainingSet, MolSet
 from params import ParamsManager, Optim
 from computation import Run
+from checkpoint import Checkpoint
 
 Presets().alberto_lcmd30()
 config = Config().config
@@ -26,6 +27,14 @@ def main():
     init_logging()
     prms = ParamsManager()
     i=0
+    checkpoint = None
+    state = None
+    phase = 'full'
+    if config['checkpoint']:
+       checkpoint = Checkpoint(config['checkpoint'])
+       state = checkpoint.load()
+       if state:
+          i = state['cycle']
 #    while not prms.check_saved():
     while True:
 #       print("Not all Parameters Converged!")
@@ -56,6 +65,10 @@ def main():
        with open('/dev/shm/afabrizi/TMP_DATA/x0','r') as f1:
           x0_ = [line.rstrip('\n') for line in f1]
 
+       if state:
+          x0_, phase = Checkpoint.restore(state)
+          state = None
+
 #       bnds=((None,None),(None,None))
        bnds=((None,None),(None,None),(0,1),(None,None),(None,None),(None,None),(None,None),(None,None),(None,None),(None,None),(None,None),(None,None))
 
@@ -68,19 +81,49 @@ def main():
           print('PAR: '+" ".join(list(map(str,params)))+' MAE: '+str(minim))
           return minim                 
 
-       print(compute_error(x0_, trset, optim, 'full', 'MAE'))
+       def compute_error_grad(params, trset, optim, kind, error_type):
+
+          optim.set_prms(params)
+
+          if error_type == 'MAE':
+              minim, grad = trset.compute_MAE_grad(kind, optim)
+          print('PAR: '+" ".join(list(map(str,params)))+' MAE: '+str(minim))
+          return minim, grad
+
+       def compute_error_fd_grad(params, trset, optim, kind, error_type):
+
+          optim.set_prms(params)
+
+          if error_type == 'MAE':
+              minim, grad = trset.compute_MAE_fd_grad(kind, optim, params)
+          print('PAR: '+" ".join(list(map(str,params)))+' MAE: '+str(minim))
+          return minim, grad
+
+       # Skipped when resuming the optimization on restored densities
+       if phase == 'full':
+          print(compute_error(x0_, trset, optim, 'full', 'MAE'))
+          if checkpoint:
+             checkpoint.save(i, 'full', x0_)
+       phase = 'full'
 
        def printer(xc):
           print('END of STEP')
           with open('/dev/shm/afabrizi/TMP_DATA/x0','w') as f:
              for s in xc:
                 f.write(str(s) + '\n')
+          if checkpoint:
+             checkpoint.save(i, 'func', xc)
           print(xc)
 
        
-       i+=1
-       OptRes=minimize(compute_error,x0_,args=(trset,optim,'func','MAE'), method='L-BFGS-B', bounds=bnds, callback=printer, options={'disp': True,'gtol': 1e-2,'maxiter':100000,'ftol':1e-4})
+       if config['linear_model']:
+          OptRes=minimize(compute_error_grad,x0_,args=(trset,optim,'func','MAE'), jac=True, method='L-BFGS-B', bounds=bnds, callback=printer, options={'disp': True,'gtol': 1e-2,'maxiter':100000,'ftol':1e-4})
+       elif config['fd_grad']:
+          OptRes=minimize(compute_error_fd_grad,x0_,args=(trset,optim,'func','MAE'), jac=True, method='L-BFGS-B', bounds=bnds, callback=printer, options={'disp': True,'gtol': 1e-2,'maxiter':100000,'ftol':1e-4})
+       else:
+          OptRes=minimize(compute_error,x0_,args=(trset,optim,'func','MAE'), method='L-BFGS-B', bounds=bnds, callback=printer, options={'disp': True,'gtol': 1e-2,'maxiter':100000,'ftol':1e-4})
 #       OptRes=minimize(compute_error,x0_,args=(trset,optim,'func','MAE'), method='L-BFGS-B', bounds=bnds, callback=printer, options={'disp': True,'gtol': 1e-2,'maxiter':10000,'ftol':1e-4,'eps':1e-1})
+       i+=1
        print(OptRes)
        print("Time for this density: %s seconds ---" % (time.time() - start_time))
 
@@ -93,7 +136,9 @@ def main():
           except:
              pass       
 
-        
+
+       ParamsManager.write_files(prms.prms, config['wb97x_params_writing'],
+                                 config['ddsc_params_writing'])
        shutil.copy('/dev/shm/afabrizi/TMP_DATA/FUNC_PAR.dat', '/home/afabrizi/wb97xddsc/TMP_DATA/FUNC_PAR.dat')
        shutil.copy('/dev/shm/afabrizi/TMP_DATA/a0b0', '/home/afabrizi/wb97xddsc/TMP_DATA/a0b0')
  
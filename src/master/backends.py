@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#
+# Project:  wb97xdDsC-optim
+# FileName: backends
+# Creation: Oct 17, 2026
+#
+
+"""How the full (big gamess) computation of a Run is executed.
+
+The backend is selected by config['full_backend'] (see Presets):
+ - 'sbatch' (default): a SLURM job is submitted with command_full, the output
+   is polled and the densities are collected from temporary_densities_repo;
+ - 'local': rungms is executed directly in a scratch directory on this
+   machine; the energies are read as soon as the process ends and the
+   densities are written straight into densities_repo. The number of
+   concurrent computations is bounded by the size of the MolSet full Pool
+   (config['processes']);
+ - 'replay': nothing is executed: the energies are read from the outputs and
+   the densities from densities_repo left by a previous run.
+
+Every backend implements full(run) returning the tuple (total energy, XC
+energy, dispersion energy) of the Run obj.
+"""
+
+import os
+import glob
+import time
+import shlex
+import shutil
+import tempfile
+import subprocess
+import logging as lg
+from random import randint
+from config import Config
+from params import ParamsManager
+
+# Try determining the version from git:
+try:
+    git_v = subprocess.check_output(['git', 'describe'],
+                                    stderr=subprocess.DEVNULL)
+except subprocess.CalledProcessError:
+    git_v = 'Not Yet Tagged!'
+
+
+__author__ = 'Riccardo Petraglia'
+__credits__ = ['Riccardo Petraglia']
+__updated__ = "2026-10-17"
+__license__ = 'GPLv2'
+__version__ = git_v
+__maintainer__ = 'Riccardo Petraglia'
+__email__ = 'riccardo.petraglia@gmail.com'
+__status__ = 'development'
+
+config = Config().config
+
+
+def full_params_files():
+    """Write the actual parameters for the full computations.
+
+    The files are in a directory of full_params_prefix named after the hash
+    of the parameters, so the jobs still in the queue keep reading the
+    parameters they were submitted with.
+
+    Returns:
+        (tuple) paths of the wb97x and of the ddsc parameters files.
+    """
+    prms = ParamsManager().prms
+    return ParamsManager.materialize(
+        prms, os.path.join(config['full_params_prefix'],
+                           ParamsManager.key(prms)))
+
+
+class SbatchBackend(object):
+    """One SLURM job for each molecule (see also computation.submit_array)."""
+
+    def full(self, run):
+        command = shlex.split('{COMMAND:s} {SBATCH_FILE:s}'
+                              .format(COMMAND=config['command_full'],
+                                      SBATCH_FILE=run._sbatch_file))
+        run._write_input()
+        time.sleep(randint(1,10))
+        run._write_sbatch(full_params_files())
+        if config['gamess_bin']:
+            run._clear_output()
+            run._run(command)
+        return run.harvest_full()
+
+
+class LocalBackend(object):
+    """rungms executed on this machine, one scratch directory for each job.
+
+    Attributes:
+        cpus: (int) cpus given to each rungms (config['local_cpus'], 1 if
+            not set).
+    """
+
+    def __init__(self):
+        self.cpus = config['local_cpus'] or 1
+
+    def full(self, run):
+        if not config['gamess_bin']:
+            msg = 'gamess_bin is needed by the local backend!'
+            lg.critical(msg)
+            raise(RuntimeError(msg))
+        run._write_input()
+        scratch = tempfile.mkdtemp(prefix=run.molID + '.',
+                                   dir=config['local_scratch'])
+        try:
+            wb97x_param, ddsc_param = full_params_files()
+            shutil.copy(run._inout_inp_path, scratch)
+            shutil.copy(ddsc_param, os.path.join(scratch, 'a0b0'))
+            shutil.copy(wb97x_param, os.path.join(scratch, 'FUNC_PAR.dat'))
+            command = [os.path.join(config['gamess_bin'], 'rungms'),
+                       os.path.basename(run._inout_inp_path), '00',
+                       str(self.cpus)]
+            env = dict(os.environ, EXTBAS='/dev/null', SLURM_TMPDIR=scratch)
+            lg.debug('Running {} in {}'.format(command, scratch))
+            with open(run._inout_out_path, 'w') as out:
+                subprocess.call(command, cwd=scratch, env=env, stdout=out,
+                                stderr=subprocess.STDOUT)
+            energies = run.read_energies()
+
+            with open(run._wb97x_saves, 'wb') as dens:
+                for datap in sorted(glob.glob(os.path.join(scratch,
+                                                           '*.data'))):
+                    with open(datap, 'rb') as data:
+                        shutil.copyfileobj(data, dens)
+            shutil.move(os.path.join(scratch, 'dDsC_PAR'), run._ddsc_saves)
+            run._move_vec(os.path.join(scratch, run.molID + '.dat'))
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        return energies
+
+
+class ReplayBackend(object):
+    """Reuse outputs and densities of a previous run."""
+
+    def full(self, run):
+        for filep in (run._wb97x_saves, run._ddsc_saves):
+            if not os.path.isfile(filep):
+                msg = 'Nothing to replay: {} is missing!'.format(filep)
+                lg.critical(msg)
+                raise(RuntimeError(msg))
+        return run.read_energies()
+
+
+BACKENDS = dict(sbatch=SbatchBackend,
+                local=LocalBackend,
+                replay=ReplayBackend)
+
+
+def get_backend():
+    """Return the backend selected by config['full_backend']."""
+    name = config['full_backend'] or 'sbatch'
+    if name not in BACKENDS:
+        msg = 'Unknown full_backend {}: use one of {}'\
+            .format(name, ', '.join(sorted(BACKENDS)))
+        lg.critical(msg)
+        raise(RuntimeError(msg))
+    return BACKENDS[name]()
+
+
+if __name__ == '__main__':
+    from computation import Run
+
+    tmpdir = tempfile.mkdtemp()
+    Config.set('densities_repo', os.path.join(tmpdir, 'densities'))
+    Config.set('sbatch_script_prefix', tmpdir)
+    Run(run_name=os.path.join(tmpdir, 'run'), tset_path=tmpdir).index = \
+        'DENS-0'
+    run = Run('dset.mol', 'dset')
+    with open(run._inout_out_path, 'w') as out:
+        out.write(' FINAL ENERGY INCLUDING dDsC DISPERSION: -120.25\n'
+                  ' DFT EXCHANGE + CORRELATION ENERGY = -10.5\n'
+                  ' Final Energy -0.02\n'
+                  ' exit gracefully\n')
+
+    print('Checking get_backend:')
+    Config.set('full_backend', 'replay')
+    assert isinstance(get_backend(), ReplayBackend)
+    Config.set('full_backend', 'nothing')
+    try:
+        get_backend()
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('Unknown backend accepted')
+    print('...Done\n')
+
+    print('Checking ReplayBackend:')
+    try:
+        ReplayBackend().full(run)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('Replayed without densities')
+    for filep in (run._wb97x_saves, run._ddsc_saves):
+        with open(filep, 'w') as f:
+            f.write('density')
+    assert ReplayBackend().full(run) == (-120.25, -10.5, -0.02)
+    print('...Done\n')
+
+    shutil.rmtree(tmpdir)
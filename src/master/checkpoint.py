@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#
+# Project:  wb97xdDsC-optim
+# FileName: checkpoint
+# Creation: Oct 17, 2026
+#
+
+"""Checkpoint of an optimization campaign.
+
+The checkpoint is a json file (config['checkpoint']) with everything needed to
+resume after a crash without running again the full computations already
+done:
+ - cycle: the index of the density cycle (see Run.index);
+ - phase: 'full' if saved at the end of the full stage of the cycle, 'func'
+   if saved during the optimization on its densities;
+ - x: the last point of the optimizer;
+ - prms: the actual parameters;
+ - density_store: the path of the density store (see densstore);
+ - molecules and func_memo: the energies of the molecules (see
+   MolSet.snapshot).
+
+The file is replaced atomically, so a crash while saving leaves the previous
+checkpoint untouched.
+
+The full stage is not checkpointed while it runs: after a crash there the
+last checkpoint is the one of the previous cycle, and the full computations
+already done are recovered only through the density store.
+
+The internal state of the optimizer is not saved: scipy's L-BFGS-B keeps its
+history inside the Fortran routine and cannot be started from a given one.
+The resumed optimization is a new L-BFGS-B run from x: it has to rebuild the
+curvature pairs in its first steps, but those steps need only mini-gamess runs
+on the restored densities (or the func memo), not full computations.
+"""
+
+import os
+import json
+import tempfile
+import logging as lg
+import params
+from trset import MolSet
+from config import Config
+
+# Try determining the version from git:
+try:
+    import subprocess
+    git_v = subprocess.check_output(['git', 'describe'],
+                                    stderr=subprocess.DEVNULL)
+except subprocess.CalledProcessError:
+    git_v = 'Not Yet Tagged!'
+
+
+__author__ = 'Riccardo Petraglia'
+__credits__ = ['Riccardo Petraglia']
+__updated__ = "2026-10-17"
+__license__ = 'GPLv2'
+__version__ = git_v
+__maintainer__ = 'Riccardo Petraglia'
+__email__ = 'riccardo.petraglia@gmail.com'
+__status__ = 'development'
+
+config = Config().config
+
+
+class Checkpoint(object):
+    """Save and load the state of the optimization.
+
+    Args:
+        filep: (str) path of the checkpoint file.
+    """
+
+    def __init__(self, filep):
+        self.filep = os.path.abspath(filep)
+
+    def save(self, cycle, phase, x):
+        """Write the checkpoint.
+
+        Args:
+            cycle: (int) index of the density cycle.
+            phase: (str) 'full' or 'func' (see module docstring).
+            x: (list) last point of the optimizer.
+        """
+        state = dict(cycle=cycle,
+                     phase=phase,
+                     x=[float(v) for v in x],
+                     prms=params.ParamsManager().prms.tolist(),
+                     density_store=config['density_store'])
+        state.update(MolSet.snapshot())
+        dirp = os.path.dirname(self.filep)
+        fd, tmp = tempfile.mkstemp(prefix='.checkpoint.', dir=dirp)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.filep)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        lg.debug('Checkpoint saved in {}'.format(self.filep))
+
+    def load(self):
+        """Read the checkpoint.
+
+        Returns:
+            (dict) the state (see module docstring), None if there is no
+            checkpoint.
+        """
+        if not os.path.isfile(self.filep):
+            return None
+        with open(self.filep, 'r') as f:
+            state = json.load(f)
+        lg.info('Checkpoint loaded from {} (cycle {}, {})'
+                .format(self.filep, state['cycle'], state['phase']))
+        return state
+
+    @staticmethod
+    def restore(state):
+        """Set the actual parameters and the molecules saved in state.
+
+        To be called once the TrainingSet has been built.
+
+        Returns:
+            (tuple) the point of the optimizer and the phase to resume:
+            'func' (the full stage can be skipped) only if all the molecules
+            have been restored, 'full' otherwise.
+        """
+        params.ParamsManager.load_actual(params.Params.fromlist(state['prms']))
+        restored = MolSet.restore(state)
+        phase = state['phase']
+        if phase == 'func' and restored < len(MolSet.container):
+            lg.warning('Not all the molecules restored: the full stage is'
+                       ' run again')
+            phase = 'full'
+        return state['x'], phase
+
+
+if __name__ == '__main__':
+    import shutil
+
+    class FakeMolecule(object):
+        _full_energy = None
+
+    Config.set('precision', 1E-8)
+    tmpdir = tempfile.mkdtemp()
+    chk = Checkpoint(os.path.join(tmpdir, 'checkpoint.json'))
+    prms = params.ParamsManager().prms.tolist()
+
+    print('Checking save/load:')
+    assert chk.load() is None, 'Missing checkpoint has to give None'
+    chk.save(3, 'func', [0.5, 1])
+    state = chk.load()
+    assert state['cycle'] == 3 and state['phase'] == 'func'
+    assert state['x'] == [0.5, 1.0] and state['prms'] == prms
+    assert state['molecules'] == {} and state['func_memo'] == []
+    print('...Done\n')
+
+    print('Checking atomic replace:')
+    snapshot = MolSet.snapshot
+    MolSet.snapshot = staticmethod(lambda: dict(molecules=object()))
+    try:
+        chk.save(4, 'full', [0.0])
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('Not serializable state saved')
+    MolSet.snapshot = snapshot
+    assert chk.load()['cycle'] == 3, 'Previous checkpoint not kept'
+    assert os.listdir(tmpdir) == ['checkpoint.json'], \
+        'Temporary files left'
+    chk.save(4, 'full', [0.0])
+    assert chk.load()['cycle'] == 4
+    assert os.listdir(tmpdir) == ['checkpoint.json'], \
+        'Temporary files left'
+    print('...Done\n')
+
+    print('Checking restore:')
+    state['prms'] = list(range(19))
+    assert Checkpoint.restore(state) == ([0.5, 1.0], 'func')
+    assert params.ParamsManager().prms.tolist() == list(range(19))
+    MolSet.container = [FakeMolecule()]
+    assert Checkpoint.restore(state) == ([0.5, 1.0], 'full'), \
+        'Molecules not restored: the full stage has to be run'
+    print('...Done\n')
+
+    shutil.rmtree(tmpdir)
@@ -41,12 +41,16 @@ Attributes:
 
 import time
 import shlex
-from random import randint
+import asyncio
 import shutil
 import logging as lg
-from make_input import Input
+from multiprocessing.pool import ThreadPool
+from make_input import Input, read_vec
 import os
-from utils import find_in_file, file_exists, create_dir
+from utils import create_dir, wait_for, LogFollower
+from backends import get_backend, full_params_files
+from densstore import DensityStore, density_store
+from params import ParamsManager
 from config import Config
 
 # Try determining the version from git:
@@ -75,6 +79,12 @@ config['well_finished_strings'] = [b'exit gracefully',
                                    b'Final Energy']
 
 
+SBATCH_RESOURCES = '#SBATCH --mem=64000\n'
+SBATCH_RESOURCES += '#SBATCH --nodes=1\n'
+SBATCH_RESOURCES += '#SBATCH --ntasks-per-node=8\n'
+#SBATCH_RESOURCES += '#SBATCH --partition=debug\n'
+
+
 class Run(object):
 
     _inout_id = None
@@ -103,6 +113,7 @@ class Run(object):
             self._inout_out_path = os.path.join(self._inout_path,
                                                 molID + '.log')
             self.molID = molID
+            self._unrestricted = None
 
             create_dir(config['densities_repo'])
 
@@ -110,6 +121,8 @@ class Run(object):
                                              self.molID + '.wb97x')
             self._ddsc_saves = os.path.join(config['densities_repo'],
                                             self.molID + '.ddsc')
+            self._vec_saves = os.path.join(config['densities_repo'],
+                                           self.molID + '.vec')
             self._sbatch_file = \
                 os.path.join(config['sbatch_script_prefix'],
                              self.molID)
@@ -132,89 +145,166 @@ class Run(object):
         __class__._inout_id = index
 
     def _write_input(self):
-        Input(self._xyzp).write(self._inout_inp_path)
+        """Write the gamess input.
+
+        With config['scf_warm_start'] the orbitals of the previous full
+        computation of this molecule (if any) are the initial guess.
+        """
+        vec = None
+        if config['scf_warm_start']:
+            vec = read_vec(self._vec_saves)
+        Input(self._xyzp).write(self._inout_inp_path, vec)
+
+    def _clear_output(self):
+        """Remove the gamess output of a previous cycle.
+
+        To be called before submitting a job: the output path does not
+        change between density cycles and _readout would otherwise read the
+        energies of the old parameters.
+        """
+        try:
+            os.remove(self._inout_out_path)
+        except FileNotFoundError:
+            pass
+
+    def _move_vec(self, punchp):
+        """Keep the punch file with the orbitals for the next cycle."""
+        if config['scf_warm_start'] and os.path.isfile(punchp):
+            shutil.move(punchp, self._vec_saves)
 
     def _run(self, command):
         lg.debug('Should run {}'.format(command))
         return subprocess.check_output(command)
 
     def _readout(self):
-        timeout = 0
+        """Wait for the gamess output and read the energies.
+
+        The output is checked as soon as something is written in the inout
+        directory, or at least every wait_for_gamess_output seconds (see
+        utils.wait_for). Each check reads only the new part of the output
+        (see utils.LogFollower).
+
+        Returns:
+            (tuple) total energy, XC energy and dispersion energy.
+        """
+        return wait_for(self._readout_check(), self._inout_path,
+                        config['wait_for_gamess_output'])
+
+    def _readout_check(self):
+        """The check of _readout (see utils.wait_for): the energies once the
+        output is complete, None before."""
+        start = time.time()
+        warn_after = config['wait_for_gamess_output'] * \
+            config['maximum_times_to_recheck']
         not_found = False
-        while True:
-            timeout += 1
-            time.sleep(config['wait_for_gamess_output'])
-            if timeout % config['maximum_times_to_recheck'] == 0:
+        follower = LogFollower(self._inout_out_path,
+                               config['well_finished_strings'])
+
+        def check():
+            nonlocal not_found, warn_after
+            if time.time() - start > warn_after:
+                warn_after += config['wait_for_gamess_output'] * \
+                    config['maximum_times_to_recheck']
                 not_found = True
                 lg.warning('Final energy not found for file {}... '
                            'Do something!!'.format(self._inout_out_path))
 
-            if not os.path.exists(self._inout_out_path): continue
+            energies = self._energies(follower.update())
+            if energies and not_found:
+                lg.warning('Final energy for file {} found!!'
+                           .format(self._inout_out_path))
+            return energies
 
-            find = find_in_file(self._inout_out_path,
-                                config['well_finished_strings'],
-                                reverse=True)
+        return check
 
-            if find[1] and find[2] and find[3]:
-                if not_found:
-                    lg.warning('Final energy for file {} found!!'
-                               .format(self._inout_out_path))
-                if abs(float(find[1].split()[5])) < float(b'0.0E-8'):
-                    msg = 'Energy in Gamess is almost zero: {:f}'.\
-                        format(float(find[1].split()[5]))
-                    lg.critical(msg)
-                    raise(RuntimeError(msg))
-
-                return (float(find[1].split()[5]),
-                        float(find[2].split()[6]), float(find[3].split()[2]))
+    def _energies(self, find):
+        """Energies from the well_finished_strings lines (None if missing)."""
+        if find[1] and find[2] and find[3]:
+            if abs(float(find[1].split()[5])) < float(b'0.0E-8'):
+                msg = 'Energy in Gamess is almost zero: {:f}'.\
+                    format(float(find[1].split()[5]))
+                lg.critical(msg)
+                raise(RuntimeError(msg))
+
+            return (float(find[1].split()[5]),
+                    float(find[2].split()[6]), float(find[3].split()[2]))
+        return None
+
+    def read_energies(self):
+        """Read the energies from a gamess output that is already complete.
+
+        Returns:
+            (tuple) total energy, XC energy and dispersion energy.
+        """
+        follower = LogFollower(self._inout_out_path,
+                               config['well_finished_strings'])
+        energies = self._energies(follower.update())
+        if energies is None:
+            msg = 'Final energy not found in {}'.format(self._inout_out_path)
+            lg.critical(msg)
+            raise(RuntimeError(msg))
+        return energies
 
     def _move_data(self):
-        dens_orig = os.path.join(config['temporary_densities_repo'],
-                                 self.molID + '.wb97x')
-        ddsc_orig = os.path.join(config['temporary_densities_repo'],
-                                 self.molID + '.ddsc')
-        while True:
-            time.sleep(config['wait_to_recheck'])
-            allfile = True
-            for filep in [dens_orig, ddsc_orig]:
-                try:
-                    file_exists(filep)
-                except FileNotFoundError:
-                    allfile = False
-            if allfile: break
+        wait_for(self._densities_check(), config['temporary_densities_repo'],
+                 config['wait_to_recheck'])
+        self._keep_densities()
+
+    def _temporary_densities(self):
+        """Where the job copies the densities (see _sbatch_body)."""
+        return [os.path.join(config['temporary_densities_repo'],
+                             self.molID + ext) for ext in ['.wb97x', '.ddsc']]
+
+    def _densities_check(self):
+        """The check of _move_data: True once both the densities are
+        written by the job, None before."""
+        dens_orig, ddsc_orig = self._temporary_densities()
+
+        def check():
+            if os.path.isfile(dens_orig) and os.path.isfile(ddsc_orig):
+                return True
+            return None
+
+        return check
+
+    def _keep_densities(self):
+        """Move the densities written by the job in densities_repo."""
+        dens_orig, ddsc_orig = self._temporary_densities()
+        self._move_vec(os.path.join(config['temporary_densities_repo'],
+                                    self.molID + '.vec'))
         shutil.move(dens_orig, self._wb97x_saves)
         shutil.move(ddsc_orig, self._ddsc_saves)
 
-    def _write_sbatch(self):
+    def _sbatch_body(self, params_files):
+        """Commands that run gamess for this molecule in a SLURM job.
+
+        Args:
+            params_files: (tuple) wb97x and ddsc parameters files (see
+                full_params_files).
+        """
         input_path, input_file = os.path.split(self._inout_inp_path)
         del(input_path)
-        txt = '#!/bin/bash\n'
-        txt += '#SBATCH -J {TITLE:s}\n'.format(TITLE=self.molID)
-        txt += '#SBATCH -o ' + os.path.join(self._inout_path,
-                                            self.molID + '.stdout') + '\n'
-        txt += '#SBATCH -e ' + os.path.join(self._inout_path,
-                                            self.molID + '.stderr') + '\n'
-        txt += '#SBATCH --mem=64000\n'
-        txt += '#SBATCH --nodes=1\n'
-        txt += '#SBATCH --ntasks-per-node=8\n'
-#        txt += '#SBATCH --partition=debug\n'
-        txt += '\n'
-#        txt += 'module load intel/14.0.2\n'
-        txt += 'export EXTBAS=/dev/null\n'
+        txt = 'export EXTBAS=/dev/null\n'
         txt += 'echo $PWD\n'
         txt += 'WORKINGDIR=$PWD\n'
         txt += 'cd $SLURM_TMPDIR\n'
         txt += 'cp {INPUTFILE:s} $SLURM_TMPDIR\n'\
             .format(INPUTFILE=self._inout_inp_path)
-        txt += 'cp {PARAMS_DIR:s}/a0b0 $SLURM_TMPDIR\n'\
-            .format(PARAMS_DIR=config['full_params_prefix'])
-        txt += 'cp {PARAMS_DIR:s}/FUNC_PAR.dat $SLURM_TMPDIR\n'.\
-            format(PARAMS_DIR=config['full_params_prefix'])
+        txt += 'cp {PARAMS:s} $SLURM_TMPDIR/a0b0\n'\
+            .format(PARAMS=params_files[1])
+        txt += 'cp {PARAMS:s} $SLURM_TMPDIR/FUNC_PAR.dat\n'.\
+            format(PARAMS=params_files[0])
         txt += '{BIN:s}/rungms {INPUT:s} 00 8 &> {OUTPUT:s}\n'.\
             format(INPUT=input_file,
                    OUTPUT=self._inout_out_path,
                    BIN=str(config['gamess_bin']))
         txt += 'joberror=$?\n'
+        if config['scf_warm_start']:
+            # The orbitals first: _move_data waits only for the densities
+            txt += 'cp $SLURM_TMPDIR/{PUNCH:s} {VEC_DEST:s}\n'.format(
+                PUNCH=self.molID + '.dat',
+                VEC_DEST=os.path.join(config['temporary_densities_repo'],
+                                      self.molID + '.vec'))
         txt += 'cat $SLURM_TMPDIR/*.data > $SLURM_TMPDIR/PARAM_UNF.dat\n'
         txt += 'cp -r $SLURM_TMPDIR/PARAM_UNF.dat {DENSITY_DEST}\n'.\
             format(DENSITY_DEST=os.path.join(config['temporary_densities_repo'],
@@ -223,39 +313,112 @@ class Run(object):
             format(dDSC_DEST=os.path.join(config['temporary_densities_repo'],
                                           self.molID + '.ddsc'))
 #        txt += 'cp -ar $SLURM_TMPDIR $WORKINGDIR\n'
+        return txt
+
+    def _write_sbatch(self, params_files):
+        txt = '#!/bin/bash\n'
+        txt += '#SBATCH -J {TITLE:s}\n'.format(TITLE=self.molID)
+        txt += '#SBATCH -o ' + os.path.join(self._inout_path,
+                                            self.molID + '.stdout') + '\n'
+        txt += '#SBATCH -e ' + os.path.join(self._inout_path,
+                                            self.molID + '.stderr') + '\n'
+        txt += SBATCH_RESOURCES
+        txt += '\n'
+#        txt += 'module load intel/14.0.2\n'
+        txt += self._sbatch_body(params_files)
         txt += 'exit\n'
 
         with open(self._sbatch_file, 'w') as f:
             f.write(txt)
 
     def full(self):
+        """Full computation with the backend in config['full_backend'].
+
+        If the density store (see densstore) already contains the results for
+        the same input and parameters nothing is computed.
+
+        Returns:
+            (tuple) total energy, XC energy and dispersion energy.
+        """
+        return self._through_store(get_backend().full)
+
+    def collect_full(self):
+        """As full, for a job already submitted by submit_array."""
+        return self._through_store(__class__.harvest_full)
+
+    def store_key(self):
+        """Key of this computation in the density store."""
+        return DensityStore.key(Input(self._xyzp).text(self._inout_inp_path),
+                                ParamsManager().prms)
+
+    def _through_store(self, compute):
+        store, key, energies = self._from_store()
+        if energies is None:
+            energies = compute(self)
+            self._to_store(store, key, energies)
+        return energies
 
-        command = shlex.split('{COMMAND:s} {SBATCH_FILE:s}'
-                              .format(COMMAND=config['command_full'],
-                                      SBATCH_FILE=self._sbatch_file))
-        self._write_input()
-        time.sleep(randint(1,10))
-        self._write_sbatch()
-        if os.path.dirname(config['ddsc_params_writing']) != config['full_params_prefix']:
-            shutil.copy(config['ddsc_params_writing'], config['full_params_prefix'])
-        if os.path.dirname(config['wb97x_params_writing']) != config['full_params_prefix']:
-            shutil.copy(config['wb97x_params_writing'], config['full_params_prefix'])
-        if config['gamess_bin']: self._run(command)
+    def _from_store(self):
+        """Take the results of this computation from the density store.
+
+        Returns:
+            (tuple) the store, the key (None both if there is no store) and
+            the energies (None if they are not in the store).
+        """
+        store = density_store()
+        if store is None:
+            return None, None, None
+        key = self.store_key()
+        return store, key, store.get(key, self._wb97x_saves,
+                                     self._ddsc_saves)
+
+    def _to_store(self, store, key, energies):
+        """Add the results of this computation to store (see _from_store)."""
+        if store is not None:
+            store.put(key, self._wb97x_saves, self._ddsc_saves, energies)
+
+    def harvest_full(self):
+        """Wait for the end of a submitted full job and collect its results.
+
+        Returns:
+            (tuple) total energy, XC energy and dispersion energy.
+        """
         energies = self._readout()
         if config['gamess_bin']: self._move_data()
         return energies
 
-    def func(self):
-        multiplicity=Input(self._xyzp).mult()
-        if int(multiplicity) > 1:
-           unrestricted='U'
-        else:
-           unrestricted='R'
-
-        wb97x_param = os.path.join(config['func_params_prefix'],
-                                   config['wb97x_params_file'])
-        ddsc_param = os.path.join(config['func_params_prefix'],
-                                  config['ddsc_params_file'])
+    @property
+    def unrestricted(self):
+        """'U' for open-shell molecules, 'R' otherwise (read only once)."""
+        if self._unrestricted is None:
+            if int(Input(self._xyzp).mult()) > 1:
+                self._unrestricted = 'U'
+            else:
+                self._unrestricted = 'R'
+        return self._unrestricted
+
+    def func(self, wb97x_param=None, ddsc_param=None):
+        """Run the mini-gamess on the saved density.
+
+        Args:
+            wb97x_param: (str) wb97x parameters file to use instead of the
+                actual parameters.
+            ddsc_param: (str) ddsc parameters file to use instead of the
+                actual parameters.
+        """
+        command = self.func_command(wb97x_param, ddsc_param)
+        return parse_func(self._run(command))
+
+    def func_command(self, wb97x_param=None, ddsc_param=None):
+        """The mini-gamess command line (see func)."""
+        if wb97x_param is None or ddsc_param is None:
+            # A directory for each process: parallel jobs never share files
+            files = ParamsManager.materialize(
+                ParamsManager().prms,
+                os.path.join(config['func_params_prefix'],
+                             'proc-{:d}'.format(os.getpid())))
+            wb97x_param = wb97x_param or files[0]
+            ddsc_param = ddsc_param or files[1]
         command = '{COMMAND:s} {WB97X_DATA:s} {DDSC_DATA:s} '\
             ' {WB97X_PARAM:s} {DDSC_PARAM:s} {UNRESTRICTED:s}'\
             .format(COMMAND=config['command_func'],
@@ -263,6 +426,100 @@ class Run(object):
                     DDSC_DATA=self._ddsc_saves,
                     WB97X_PARAM=wb97x_param,
                     DDSC_PARAM=ddsc_param,
-                    UNRESTRICTED=unrestricted)
-        command = shlex.split(command)
-        return (float(self._run(command).split()[1]))
+                    UNRESTRICTED=self.unrestricted)
+        return shlex.split(command)
+
+
+def parse_func(output):
+    """Energy in the output of the mini-gamess."""
+    return float(output.split()[1])
+
+
+def func_many(jobs):
+    """Run many mini-gamess directly from this process.
+
+    The commands are launched by an asyncio event loop, at most
+    config['mini_processes'] at the same time, and their outputs are parsed
+    here: nothing is sent to other Python processes.
+
+    Args:
+        jobs: (list) tuples (Run obj, wb97x parameters file, ddsc parameters
+            file), see Run.func.
+
+    Returns:
+        (list) the energy of each job.
+    """
+    async def run_all():
+        semaphore = asyncio.Semaphore(config['mini_processes'] or 1)
+
+        async def run_one(run, wb97x_param, ddsc_param):
+            command = run.func_command(wb97x_param, ddsc_param)
+            async with semaphore:
+                proc = await asyncio.create_subprocess_exec(
+                    *command, stdout=subprocess.PIPE)
+                out, _ = await proc.communicate()
+            if proc.returncode:
+                raise subprocess.CalledProcessError(proc.returncode, command,
+                                                    out)
+            return parse_func(out)
+
+        return await asyncio.gather(*[run_one(*job) for job in jobs])
+
+    return asyncio.run(run_all())
+
+
+def submit_array(runs):
+    """Submit the full computation of many molecules as one SLURM job array.
+
+    Writes the inputs and a single sbatch script where the task
+    $SLURM_ARRAY_TASK_ID runs the molecule runs[$SLURM_ARRAY_TASK_ID], then
+    submits it with one command_full call. The results have to be collected
+    with Run.harvest_full for each run.
+
+    The runs already in the density store are not submitted: their
+    collect_full takes the results from the store.
+
+    Args:
+        runs: (list) Run objs of the molecules to compute.
+
+    Returns:
+        (str) path of the sbatch script (None if nothing was submitted).
+    """
+    store = density_store()
+    if store is not None:
+        runs = [run for run in runs if not store.has(run.store_key())]
+        if not runs:
+            return None
+    sbatch_file = os.path.join(config['sbatch_script_prefix'],
+                               'array-' + str(runs[0].index))
+    params_files = full_params_files()
+    txt = '#!/bin/bash\n'
+    txt += '#SBATCH -J {TITLE:s}\n'.format(TITLE='array-' + str(runs[0].index))
+    txt += '#SBATCH -o ' + sbatch_file + '-%a.stdout\n'
+    txt += '#SBATCH -e ' + sbatch_file + '-%a.stderr\n'
+    txt += '#SBATCH --array=0-{:d}\n'.format(len(runs) - 1)
+    txt += SBATCH_RESOURCES
+    txt += '\n'
+    txt += 'case $SLURM_ARRAY_TASK_ID in\n'
+    # Input.write waits a bit after writing: do it in parallel
+    with ThreadPool(config['processes']) as pool:
+        pool.map(Run._write_input, runs)
+    for n, run in enumerate(runs):
+        txt += '{:d})  # {:s}\n'.format(n, run.molID)
+        txt += run._sbatch_body(params_files)
+        txt += ';;\n'
+    txt += 'esac\n'
+    txt += 'exit\n'
+    with open(sbatch_file, 'w') as f:
+        f.write(txt)
+
+    command = shlex.split('{COMMAND:s} {SBATCH_FILE:s}'
+                          .format(COMMAND=config['command_full'],
+                                  SBATCH_FILE=sbatch_file))
+    if config['gamess_bin']:
+        for run in runs:
+            run._clear_output()
+        runs[0]._run(command)
+    lg.info('Job array {} submitted with {} molecules'
+            .format(sbatch_file, len(runs)))
+    return sbatch_file
@@ -49,6 +49,7 @@ class Config(object):
         loglevel=None,
         logfile=None,
         processes=None,
+        mini_processes=None,
         precision=None,
         wb97x_params_file=None,  # Was ParamFile
         ddsc_params_file=None,  # Was dDsCParamFile
@@ -65,6 +66,25 @@ class Config(object):
         command_func=None,
         wb97x_params_writing=None,
         ddsc_params_writing=None,
+        xc_engine=None,
+        linear_model=None,
+        sbatch_array=None,
+        full_backend=None,
+        local_scratch=None,
+        local_cpus=None,
+        density_store=None,
+        density_store_size=None,
+        write_params_files=None,
+        func_memo_size=None,
+        ddsc_post_scf=None,
+        pipeline_func=None,
+        full_supervisor=None,
+        full_job_timeout=None,
+        command_cancel=None,
+        func_async=None,
+        checkpoint=None,
+        scf_warm_start=None,
+        fd_grad=None,
     )
 
     _help = dict(
@@ -77,6 +97,7 @@ class Config(object):
         loglevel='Level of the log file',
         logfile='Path to the log file',
         processes='Maximum number of parallel processes',
+        mini_processes='Maximum number of parallel mini-gamess processes',
         precision='Maximum precision in comparing float',
         wb97x_params_file='Name of the file containing the wb97x parameters',
         ddsc_params_file='Name of the file containing the ddsc parameters',
@@ -98,6 +119,52 @@ class Config(object):
         command_func='Command to execute for the mini-gamess',
         wb97x_params_writing='Where wb97x params are written by ParamsMangaer',
         ddsc_params_writing='Where ddsc params are written by ParamsMangaer',
+        xc_engine='If True the func energies are computed in-process by'
+                ' the XCEngine (linear in the XC coefficients)',
+        linear_model='If True the func MAE of the TrainingSet is computed'
+                ' as |A.c + b| (see linmodel)',
+        sbatch_array='If True all the full computations of a cycle are'
+                ' submitted as a single SLURM job array',
+        full_backend='How the full gamess is run: sbatch (default), local'
+                ' or replay (see backends)',
+        local_scratch='Where the local backend creates the scratch dirs'
+                ' (None for the system default)',
+        local_cpus='Number of cpus given to each rungms by the local'
+                ' backend',
+        density_store='Path of the content addressed store of the'
+                ' densities (None to disable it, see densstore)',
+        density_store_size='Maximum size (MB) of the density store'
+                ' (None for no limit)',
+        write_params_files='If True every change of the parameters is'
+                ' also written in wb97x_params_writing and'
+                ' ddsc_params_writing',
+        func_memo_size='Number of parameter vectors whose func energies'
+                ' are remembered (None to disable the memo)',
+        ddsc_post_scf='If True dDsC is taken as a post-SCF correction:'
+                ' changing only tta/ttb needs no new density and the func'
+                ' energies are split in XC and dispersion terms',
+        pipeline_func='If True (needs func_memo_size) the func energy of'
+                ' each molecule is started as soon as its full computation'
+                ' ends',
+        full_supervisor='If True the sbatch full computations are'
+                ' submitted and harvested by one asyncio event loop instead'
+                ' of the full Pool (see supervisor)',
+        full_job_timeout='Maximum time (s) for each full computation run'
+                ' by the supervisor (None for no limit)',
+        command_cancel='Command to cancel a SLURM job (e.g. ssh <master>'
+                ' /usr/bin/scancel): used by the supervisor for the jobs'
+                ' exceeding full_job_timeout (None to only report them)',
+        func_async='If True the mini-gamess are launched by an asyncio'
+                ' event loop of the main process instead of the func Pool',
+        checkpoint='Path of the checkpoint file used to resume the'
+                ' optimization (None to disable it, see checkpoint)',
+        scf_warm_start='If True the $VEC of the punch file (<molID>.dat in'
+                ' the scratch) is kept in densities_repo and used as MOREAD'
+                ' guess by the next full computation of the molecule',
+        fd_grad='If True main_opt gives L-BFGS-B the batched finite'
+                ' difference gradient (TrainingSet.compute_MAE_fd_grad,'
+                ' fulldftlisted systems kept constant) instead of letting'
+                ' scipy take the differences',
     )
 
     @staticmethod
@@ -172,6 +239,7 @@ class Presets(object):
                     sbatch_script_prefix=join('/home/afabrizi/wb97xddsc/TMP_DATA'),
                     command_full='ssh lcmdlc2 /usr/bin/sbatch',
                     command_func=join(ram, 'STARTall.x'),
+                    full_backend='sbatch',
                     )
 
         self._insert_in_config(prst)
@@ -205,6 +273,11 @@ class Presets(object):
 
         self._insert_in_config(prst)
 
+    def test_replay(self):
+        """As test, reusing the outputs and densities of a previous run."""
+        self.test()
+        Config.set('full_backend', 'replay')
+
     def riccardo_lcmdlc2(self):
         home = Config.get('home')
         root = join(home, 'wb97xddsc/wb97xdDsC-optim')  # shortening lines below
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#
+# Project:  wb97xdDsC-optim
+# FileName: densstore
+# Creation: Oct 17, 2026
+#
+
+"""Content addressed store of the full computation results.
+
+The files in densities_repo are named after the molecule id only, so they are
+overwritten at every density cycle and cannot be shared among runs. The
+DensityStore keeps the densities (wb97x and ddsc files) and the energies of
+each full computation under a key that is the hash of everything the SCF
+depends on: the gamess input (geometry, charge, multiplicity, basis and the
+keywords of Input._template) and the parameters used for the SCF. A full
+computation whose key is already in the store is not executed again.
+
+The store is bounded by config['density_store_size'] (MB): when it is
+exceeded the least recently used entries are removed.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import logging as lg
+from utils import create_dir
+from config import Config
+
+# Try determining the version from git:
+try:
+    import subprocess
+    git_v = subprocess.check_output(['git', 'describe'],
+                                    stderr=subprocess.DEVNULL)
+except subprocess.CalledProcessError:
+    git_v = 'Not Yet Tagged!'
+
+
+__author__ = 'Riccardo Petraglia'
+__credits__ = ['Riccardo Petraglia']
+__updated__ = "2026-10-17"
+__license__ = 'GPLv2'
+__version__ = git_v
+__maintainer__ = 'Riccardo Petraglia'
+__email__ = 'riccardo.petraglia@gmail.com'
+__status__ = 'development'
+
+config = Config().config
+
+
+class DensityStore(object):
+    """Densities and energies of full computations addressed by content.
+
+    Every entry is made of three files in path: key.wb97x, key.ddsc and
+    key.energies (the last one is written last and marks a complete entry;
+    its mtime is the time of the last use).
+
+    Args:
+        path: (str) directory of the store.
+        max_size: (float) maximum size in MB (None for no limit).
+    """
+
+    _suffixes = ['.wb97x', '.ddsc', '.energies']
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        create_dir(path)
+
+    @staticmethod
+    def key(input_text, prms):
+        """Hash of a gamess input and of the parameters used for the SCF.
+
+        Args:
+            input_text: (str) content of the gamess input.
+            prms: (Params) parameters of the full computation.
+        """
+        sha = hashlib.sha256(input_text.encode())
+        sha.update(' '.join(repr(v) for v in prms.tolist()).encode())
+        return sha.hexdigest()
+
+    def _files(self, key):
+        return [os.path.join(self.path, key + s) for s in __class__._suffixes]
+
+    def has(self, key):
+        return os.path.isfile(self._files(key)[2])
+
+    def get(self, key, wb97x_dest, ddsc_dest):
+        """Copy the densities of key in the destinations.
+
+        Returns:
+            (tuple) the energies of the full computation or None if key is not
+            in the store.
+        """
+        wb97x, ddsc, energies = self._files(key)
+        try:
+            with open(energies, 'r') as f:
+                energies = tuple(json.load(f))
+            shutil.copy(wb97x, wb97x_dest)
+            shutil.copy(ddsc, ddsc_dest)
+        except (FileNotFoundError, ValueError):
+            return None
+        os.utime(self._files(key)[2])
+        lg.debug('Density {} taken from the store'.format(key))
+        return energies
+
+    def put(self, key, wb97x_src, ddsc_src, energies):
+        """Add the results of a full computation to the store.
+
+        Nothing is stored if the densities have not been produced (e.g. no
+        gamess_bin or replay backend).
+        """
+        if not (os.path.isfile(wb97x_src) and os.path.isfile(ddsc_src)):
+            lg.debug('Density {} not stored: files missing'.format(key))
+            return
+        def write_energies(tmp):
+            with open(tmp, 'w') as f:
+                json.dump(list(energies), f)
+
+        for src, dest in zip([wb97x_src, ddsc_src], self._files(key)):
+            self._replace(dest, lambda tmp: shutil.copy(src, tmp))
+        self._replace(self._files(key)[2], write_energies)
+        self._evict()
+
+    def _replace(self, dest, write):
+        """Replace dest atomically with the file written by write(tmp).
+
+        The temporary file has a unique name: many processes can put the
+        same key at the same time.
+        """
+        fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(dest) + '.',
+                                   dir=self.path)
+        os.close(fd)
+        try:
+            write(tmp)
+            os.replace(tmp, dest)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _evict(self):
+        """Remove the least recently used entries exceeding max_size."""
+        if self.max_size is None:
+            return
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith('.energies'):
+                continue
+            key = name[:-len('.energies')]
+            try:
+                size = sum(os.path.getsize(f) for f in self._files(key))
+                entries.append((os.path.getmtime(self._files(key)[2]),
+                                size, key))
+            except FileNotFoundError:
+                continue  # removed by another process
+            total += size
+        for mtime, size, key in sorted(entries):
+            if total <= self.max_size * 1024 * 1024:
+                break
+            for filep in reversed(self._files(key)):
+                try:
+                    os.remove(filep)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            lg.debug('Density {} removed from the store'.format(key))
+
+
+def density_store():
+    """The DensityStore in config['density_store'] (None if not set)."""
+    if not config['density_store']:
+        return None
+    return DensityStore(config['density_store'],
+                        config['density_store_size'])
+
+
+if __name__ == '__main__':
+    import tempfile
+    import params
+
+    tmpdir = tempfile.mkdtemp()
+    srcs = [os.path.join(tmpdir, n) for n in ['src.wb97x', 'src.ddsc']]
+    dests = [os.path.join(tmpdir, n) for n in ['dest.wb97x', 'dest.ddsc']]
+    for src in srcs:
+        with open(src, 'w') as f:
+            f.write(os.path.basename(src) * 100)
+    values = list(range(1, 16))
+    prms = params.Params.fromlist(values)
+
+    print('Checking key:')
+    key = DensityStore.key('input', prms)
+    assert key == DensityStore.key('input', prms)
+    assert key != DensityStore.key('input ', prms)
+    assert key != DensityStore.key(
+        'input', params.Params.fromlist(values[::-1]))
+    print('...Done\n')
+
+    print('Checking put/get/has:')
+    store = DensityStore(os.path.join(tmpdir, 'store'))
+    assert not store.has(key)
+    assert store.get(key, *dests) is None, 'Missing key has to give None'
+    store.put(key, *srcs, (-1.0, -2.0, -3.0))
+    assert store.has(key)
+    assert store.get(key, *dests) == (-1.0, -2.0, -3.0)
+    for src, dest in zip(srcs, dests):
+        with open(src, 'r') as f, open(dest, 'r') as g:
+            assert f.read() == g.read(), 'Density not copied'
+    assert sorted(os.listdir(store.path)) == \
+        sorted(os.path.basename(f) for f in store._files(key)), \
+        'Temporary files left in the store'
+    store.put('nofiles', dests[0], 'missing', (-1.0, -2.0, -3.0))
+    assert not store.has('nofiles'), 'Stored without densities'
+    print('...Done\n')
+
+    print('Checking evict:')
+    entry_size = sum(os.path.getsize(f) for f in store._files(key))
+    store.max_size = 3.5 * entry_size / 1024 / 1024
+    keys = [key] + ['key{}'.format(n) for n in range(2)]
+    for n, k in enumerate(keys[1:]):
+        store.put(k, *srcs, (-1.0, -2.0, -3.0))
+        os.utime(store._files(k)[2], (n + 10, n + 10))
+    os.utime(store._files(key)[2], (20, 20))  # key is the last used
+    store.put('key2', *srcs, (-1.0, -2.0, -3.0))
+    assert [store.has(k) for k in keys + ['key2']] == \
+        [True, False, True, True], 'Least recently used not removed'
+    print('...Done\n')
+
+    shutil.rmtree(tmpdir)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#
+# Project:  wb97xdDsC-optim
+# FileName: functerms
+# Creation: Oct 17, 2026
+#
+
+"""The func energy of a molecule split in XC and dispersion terms.
+
+On a frozen density the XC energy depends only on the XC parameters (cxhf,
+omega, cx_aa, cc_aa, cc_ab) and the dDsC dispersion only on tta and ttb, so:
+
+    E(xc, d) = E(xc0, d0) + X(xc) + D(d)    with X(xc0) = D(d0) = 0
+
+where (xc0, d0) is the first point computed on the density. The mini-gamess
+gives only E, but every computed point where one of the two terms is already
+known gives the other one: e.g. after a finite difference step on tta, the
+same tta with any XC parameters already seen needs no mini-gamess.
+"""
+
+import collections
+import numpy as np
+from config import Config
+
+# Try determining the version from git:
+try:
+    import subprocess
+    git_v = subprocess.check_output(['git', 'describe'],
+                                    stderr=subprocess.DEVNULL)
+except subprocess.CalledProcessError:
+    git_v = 'Not Yet Tagged!'
+
+
+__author__ = 'Riccardo Petraglia'
+__credits__ = ['Riccardo Petraglia']
+__updated__ = "2026-10-17"
+__license__ = 'GPLv2'
+__version__ = git_v
+__maintainer__ = 'Riccardo Petraglia'
+__email__ = 'riccardo.petraglia@gmail.com'
+__status__ = 'development'
+
+config = Config().config
+
+
+class FuncTerms(object):
+    """XC and dispersion terms of the func energy of one molecule.
+
+    Args:
+        size: (int) maximum number of XC and of dispersion terms kept (the
+            least recently used are forgotten).
+
+    Attributes:
+        anchor: (float) energy of the first point (None if nothing has been
+            computed on this density).
+        xc: (OrderedDict) XC parameters (rounded): X term.
+        disp: (OrderedDict) (tta, ttb) (rounded): D term.
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        """Forget everything (to be called when the density changes)."""
+        self.anchor = None
+        self.xc = collections.OrderedDict()
+        self.disp = collections.OrderedDict()
+
+    @staticmethod
+    def _keys(prms):
+        """Rounded XC and dispersion parameters of prms."""
+        values = np.round(np.array(prms.tolist()) / config['precision'])\
+            .astype(np.int64).tolist()
+        return tuple(values[2:]), tuple(values[:2])
+
+    def _use(self, terms, key):
+        terms.move_to_end(key)
+        return terms[key]
+
+    def _set(self, terms, key, value):
+        terms[key] = value
+        while len(terms) > self.size:
+            terms.popitem(last=False)
+
+    def get(self, prms):
+        """Func energy for prms if both the terms are known, None otherwise."""
+        if self.anchor is None:
+            return None
+        xc, disp = __class__._keys(prms)
+        if xc not in self.xc or disp not in self.disp:
+            return None
+        return self.anchor + self._use(self.xc, xc) + \
+            self._use(self.disp, disp)
+
+    def add(self, prms, energy):
+        """Learn the terms from the func energy computed with prms."""
+        xc, disp = __class__._keys(prms)
+        if self.anchor is None:
+            self.anchor = energy
+            self._set(self.xc, xc, 0.0)
+            self._set(self.disp, disp, 0.0)
+        elif xc in self.xc and disp not in self.disp:
+            self._set(self.disp, disp,
+                      energy - self.anchor - self._use(self.xc, xc))
+        elif disp in self.disp and xc not in self.xc:
+            self._set(self.xc, xc,
+                      energy - self.anchor - self._use(self.disp, disp))
+
+
+if __name__ == '__main__':
+    import copy
+    import params
+
+    Config.set('precision', 1E-8)
+
+    def fake_energy(prms):
+        xc = np.array(prms.tolist()[2:])
+        return -100.0 + np.sin(xc).sum() + prms['tta'][0] * prms['ttb'][0]
+
+    def displaced(prms, **values):
+        new = copy.deepcopy(prms)
+        for k, v in values.items():
+            new[k] = v
+        return new
+
+    prms0 = params.Params.fromlist([1.0, 1.0, 0.158, 0.3, 0.842, 0.726, 1.044,
+                                    -6.9, 6.6, 1.0, -4.3, 22.2, -51.7, 28.2,
+                                    1.0, 0.7, -4.4, 3.1, -0.0])
+    prms_d = displaced(prms0, tta=1.5)
+    prms_x = displaced(prms0, omega=0.4)
+    prms_xd = displaced(prms0, tta=1.5, omega=0.4)
+
+    print('Checking anchor:')
+    terms = FuncTerms()
+    assert terms.get(prms0) is None
+    terms.add(prms0, fake_energy(prms0))
+    assert terms.anchor == fake_energy(prms0)
+    assert terms.get(prms0) == fake_energy(prms0)
+    assert terms.get(prms_d) is None and terms.get(prms_x) is None
+    print('...Done\n')
+
+    print('Checking X/D decomposition:')
+    terms.add(prms_d, fake_energy(prms_d))
+    terms.add(prms_x, fake_energy(prms_x))
+    assert abs(terms.get(prms_d) - fake_energy(prms_d)) < 1E-10
+    assert abs(terms.get(prms_x) - fake_energy(prms_x)) < 1E-10
+    assert abs(terms.disp[FuncTerms._keys(prms_d)[1]] - 0.5) < 1E-10
+    print('...Done\n')
+
+    print('Checking recombination:')
+    assert abs(terms.get(prms_xd) - fake_energy(prms_xd)) < 1E-10, \
+        'Known terms not recombined'
+    prms_new = displaced(prms0, tta=2.0, omega=0.5)
+    terms.add(prms_new, fake_energy(prms_new))
+    assert terms.get(prms_new) is None, 'Learned from two unknown terms'
+    print('...Done\n')
+
+    print('Checking size and clear:')
+    terms.size = 2
+    for omega in [0.6, 0.7]:
+        new = displaced(prms0, omega=omega)
+        terms.add(new, fake_energy(new))
+    assert len(terms.xc) == 2 and terms.get(prms_x) is None, \
+        'Least recently used term not forgotten'
+    terms.clear()
+    assert terms.anchor is None and not terms.xc and not terms.disp
+    assert terms.get(prms0) is None
+    print('...Done\n')
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#
+# Project:  wb97xdDsC-optim
+# FileName: linmodel
+# Creation: Oct 17, 2026
+#
+
+"""The func errors of a training set as a linear model.
+
+The func energy of a molecule is linear in the 15 XC coefficients (see
+xcengine) and the energy of a System is a linear combination of molecular
+energies (System._apply_rule), so for fixed densities the errors of all the
+systems are:
+
+    errors = A.c + b
+
+with A of size n_systems x 15. The MAE of the TrainingSet (mean over the
+datasets of the MAE of each dataset, as in Set.compute_MAE) becomes a weighted
+sum of |A.c + b|.
+
+A and b are computed from the XCEngine moments and offsets and are rebuilt
+only when the engine changes (new density or new omega, tta, ttb).
+"""
+
+import copy
+import numpy as np
+from xcengine import LINEAR, linear_vector
+
+# Try determining the version from git:
+try:
+    import subprocess
+    git_v = subprocess.check_output(['git', 'describe'],
+                                    stderr=subprocess.DEVNULL)
+except subprocess.CalledProcessError:
+    git_v = 'Not Yet Tagged!'
+
+
+__author__ = 'Riccardo Petraglia'
+__credits__ = ['Riccardo Petraglia']
+__updated__ = "2026-10-17"
+__license__ = 'GPLv2'
+__version__ = git_v
+__maintainer__ = 'Riccardo Petraglia'
+__email__ = 'riccardo.petraglia@gmail.com'
+__status__ = 'development'
+
+HARTREE2KCAL = 627.5096080305927  # The same used in System._apply_rule
+
+
+class LinearModel(object):
+    """Errors of the systems of a TrainingSet as A.c + b.
+
+    Args:
+        trset: (TrainingSet) the training set to be modeled.
+
+    Attributes:
+        systems: (list) System objs, one for each row of A.
+        weights: (np.array) weight of each system in the MAE.
+        mols: (list) indexes (in MolSet.container) of the needed molecules.
+        rule: (np.array) n_systems x n_mols, kcal/mol factors of the rules
+            (zero rows for the fulldftlisted systems).
+        A: (np.array) n_systems x 15.
+        b: (np.array) n_systems.
+        fd_step: (float) step of the finite differences used for the
+            parameters that are not linear (tta, ttb, omega...).
+
+    Note: the error of a fulldftlisted system is not linear (it needs a full
+    computation for each parameter set): its row of A is zero and its b is
+    refreshed by MAE_prms with the actual parameters.
+    """
+
+    fd_step = 1E-3
+
+    def __init__(self, trset):
+        self.systems = []
+        weights = []
+        for dset in trset.container:
+            weight = 1.0 / float(len(dset.container) - len(dset.blacklist))
+            for system in dset.container:
+                self.systems.append(system)
+                weights.append(weight)
+        self.weights = np.array(weights) / \
+            float(len(trset.container) - len(trset.blacklist))
+
+        self.mols = sorted({i for s in self.systems for i in s._needed_mol})
+        column = {i: n for n, i in enumerate(self.mols)}
+        self.rule = np.zeros((len(self.systems), len(self.mols)))
+        for row, system in enumerate(self.systems):
+            if system.fulldftlisted:
+                continue
+            for i, coef in zip(system._needed_mol, system.rule):
+                self.rule[row, column[i]] += coef * HARTREE2KCAL
+        self.ref = np.array([s.ref_ener for s in self.systems])
+        self._fulldft_rows = [row for row, s in enumerate(self.systems)
+                              if s.fulldftlisted]
+        self.A = None
+        self.b = None
+        self._generation = None
+
+    def update(self, engine, container):
+        """Rebuild A and b if the engine changed.
+
+        Args:
+            engine: (XCEngine) already prepared for all the self.mols.
+            container: (list) MolSet.container
+        """
+        if engine.generation == self._generation:
+            return
+        rows = [engine.rows[i] for i in self.mols]
+        self.uni = np.array([container[i]._uni_energy for i in self.mols])
+        self.A = self.rule.dot(engine.moments[rows])
+        self.b = self.rule.dot(self.uni + engine.offset[rows]) - self.ref
+        self._generation = engine.generation
+
+    def errors(self, c):
+        """Signed errors of the systems.
+
+        Args:
+            c: (np.array) 15 XC coefficients or n_vectors x 15.
+
+        Returns:
+            (np.array) n_systems or n_vectors x n_systems errors.
+        """
+        c = np.asarray(c)
+        return c.dot(self.A.T) + self.b
+
+    def MAE(self, c):
+        """Training set MAE (or one for each vector if c is 2D)."""
+        return np.abs(self.errors(c)).dot(self.weights)
+
+    def MAE_prms(self, prms):
+        """Training set MAE for a Params obj (the actual parameters)."""
+        for row in self._fulldft_rows:
+            self.b[row] = self.systems[row].full_energy_error()
+        return float(self.MAE(linear_vector(prms)))
+
+    def MAE_grad_prms(self, prms, names, evaluate_many):
+        """Training set MAE and its gradient for a Params obj.
+
+        The derivatives with respect to the linear coefficients are analytic;
+        for the other parameters forward finite differences are used: the
+        func energies in the displaced points are computed by evaluate_many
+        (the A.c + b model is not valid there) together with the ones in prms,
+        so that both the terms of the differences come from the mini-gamess
+        (the model agrees with it only within XCEngine.tolerance, too much
+        for a step of fd_step). The fulldftlisted systems are kept constant
+        in the finite differences.
+
+        Args:
+            prms: (Params) actual parameters.
+            names: (list) parameters keys (as in Optim).
+            evaluate_many: (callable) evaluate_many(prms_list, idxs) has to
+                return, for each Params in prms_list, a dict index: energy
+                computed by the mini-gamess; all the displaced points are
+                given to it together.
+
+        Returns:
+            (float, np.array) MAE and gradient (one element for each name).
+        """
+        mae = self.MAE_prms(prms)
+        errors = self.errors(linear_vector(prms))
+        sign_w = np.sign(errors) * self.weights
+        grad = np.zeros(len(names))
+        displaced = []
+        for n, name in enumerate(names):
+            if name in LINEAR:
+                grad[n] = sign_w.dot(self.A[:, LINEAR.index(name)])
+                continue
+            prms_h = copy.deepcopy(prms)
+            prms_h[name] = prms[name][0] + __class__.fd_step
+            displaced.append((n, prms_h))
+        if not displaced:
+            return mae, grad
+        energies = evaluate_many([prms] + [p for n, p in displaced],
+                                 self.mols)
+        maes = self._MAE_energies(energies, self.uni,
+                                  errors[self._fulldft_rows])
+        for (n, prms_h), mae_h in zip(displaced, maes[1:]):
+            grad[n] = (mae_h - maes[0]) / __class__.fd_step
+        return mae, grad
+
+    def MAE_energies(self, energies, container):
+        """Training set MAE from the func energies given by the mini-gamess.
+
+        Does not need the XCEngine: used when the energies are computed
+        directly (e.g. many parameter sets at once). The fulldftlisted
+        systems keep the error they have with the actual parameters.
+
+        Args:
+            energies: (list) dicts index: energy (one for each parameter set)
+            container: (list) MolSet.container
+
+        Returns:
+            (list) one MAE for each dict in energies.
+        """
+        uni = np.array([container[i]._uni_energy for i in self.mols])
+        fulldft = [self.systems[row].full_energy_error()
+                   for row in self._fulldft_rows]
+        return self._MAE_energies(energies, uni, fulldft)
+
+    def _MAE_energies(self, energies, uni, fulldft):
+        """As MAE_energies, with the uni energies (in self.mols order) and
+        the errors of the fulldftlisted systems given."""
+        maes = []
+        for energies_h in energies:
+            energies_h = np.array([energies_h[i] for i in self.mols])
+            errors_h = self.rule.dot(uni + energies_h) - self.ref
+            errors_h[self._fulldft_rows] = fulldft
+            maes.append(float(np.abs(errors_h).dot(self.weights)))
+        return maes
+
+
+if __name__ == '__main__':
+    import params
+    from trset import MolSet, System, Set
+    from xcengine import XCEngine
+    from config import Config
+
+    Config.set('precision', 1E-8)
+    rng = np.random.RandomState(0)
+    true_moments = rng.uniform(-1, 1, (5, len(LINEAR)))
+    true_offset = rng.uniform(-100, -10, 5)
+
+    def fake_evaluate(prms, idxs):
+        c = linear_vector(prms)
+        return {i: true_offset[i] + prms['tta'][0] + true_moments[i].dot(c)
+                for i in idxs}
+
+    class FakeMolecule(object):
+        def __init__(self, uni):
+            self._uni_energy = uni
+            self.func_energy = None
+            self.full_energy = uni - 50.0
+
+    def fake_system(needed, rule, ref, fulldft=False):
+        system = System.__new__(System)
+        system.id = 'fake.' + '-'.join(map(str, needed))
+        system._needed_mol = needed
+        system.rule = rule
+        system.ref_ener = ref
+        system.blacklisted = False
+        system.fulldftlisted = fulldft
+        return system
+
+    def fake_set(systems):
+        dset = Set('fake')
+        dset.container = systems
+        return dset
+
+    def set_func_energies(prms):
+        energies = fake_evaluate(prms, list(range(len(MolSet.container))))
+        for i, mol in enumerate(MolSet.container):
+            mol.func_energy = mol._uni_energy + energies[i]
+
+    MolSet.container = [FakeMolecule(u) for u in rng.uniform(-10, 10, 5)]
+    trset = fake_set([fake_set([fake_system([0, 1], [1, -1], 15.0),
+                                fake_system([2, 0], [1, -2], -40.0),
+                                fake_system([3], [1], 120.0, True)]),
+                      fake_set([fake_system([4, 3, 1], [2, -1, -1], 7.0)])])
+    prms = params.Params.fromlist([1.0, 1.0, 0.158, 0.3, 0.842, 0.726, 1.044,
+                                   -6.9, 6.6, 1.0, -4.3, 22.2, -51.7, 28.2,
+                                   1.0, 0.7, -4.4, 3.1, -0.0])
+    model = LinearModel(trset)
+    engine = XCEngine(fake_evaluate)
+    engine.prepare(prms, model.mols)
+    model.update(engine, MolSet.container)
+
+    print('Checking MAE_prms against Set.compute_MAE:')
+    for value in [-2.0, 0.5, 3.0]:
+        new = copy.deepcopy(prms)
+        new['cc_ab_2'] = value
+        set_func_energies(new)
+        assert abs(model.MAE_prms(new) - trset.compute_MAE('func')) < 1E-8
+    print('...Done\n')
+
+    print('Checking the gradient:')
+    names = ['cc_aa_1', 'cc_ab_3', 'tta']
+
+    def evaluate_many(prms_list, idxs):
+        return [fake_evaluate(p, idxs) for p in prms_list]
+
+    def fd_MAE(name, h):
+        new = copy.deepcopy(prms)
+        new[name] = prms[name][0] + h
+        set_func_energies(new)
+        return trset.compute_MAE('func')
+
+    mae, grad = model.MAE_grad_prms(prms, names, evaluate_many)
+    set_func_energies(prms)
+    assert abs(mae - trset.compute_MAE('func')) < 1E-8
+    for name, g in zip(names, grad):
+        fd = (fd_MAE(name, 1E-6) - fd_MAE(name, -1E-6)) / 2E-6
+        assert abs(g - fd) < 1E-4 * max(1.0, abs(fd)), \
+            'Wrong derivative for {}: {} {}'.format(name, g, fd)
+    print('...Done\n')
@@ -102,9 +102,27 @@ class Input(object):
                     float(self.z[i]))
             self.gamess['DATA'].append(txt)
 
-    def write(self, filep):
+    def write(self, filep, vec=None):
+        with open(filep, 'w') as outfp:
+            outfp.write(self.text(filep, vec))
+            time.sleep(.5)
+
+    def text(self, filep, vec=None):
+        """Return the content of the gamess input to be written in filep.
+
+        Args:
+            filep: (str) where the input will be written (see basis_file).
+            vec: (str) $VEC group (see read_vec) used as initial guess of the
+                SCF (MOREAD); None for the default guess.
+        """
         self._building_data()
         self._set_keyword_based_on_structures()
+        self.gamess.pop('GUESS', None)
+        if vec is not None:
+            norb = vec_orbitals(vec)
+            if self.gamess['CONTRL']['SCFTYP'] == 'UHF':
+                norb //= 2  # alpha and beta orbitals
+            self.gamess['GUESS'] = dict(GUESS='MOREAD', NORB=str(norb))
         txt = []
         for kw in self.gamess:
             if kw == 'DATA':
@@ -121,21 +139,36 @@ class Input(object):
             txt_line += '$END'
             txt.append(txt_line)
 
-        m = re.search('S-022', str(filep))
-        if m is not None:
-           with open('/dev/shm/afabrizi/basisS22','r') as basis:
-               line=(" "+"\n".join(map(str,[line.strip() for line in basis])))
-               line2=' '.join(line.splitlines(True))
-               txt.append(line2)
-        else:
-           with open('/dev/shm/afabrizi/basis','r') as basis:
-               line=(" "+"\n".join(map(str,[line.strip() for line in basis])))
-               line2=' '.join(line.splitlines(True))
-               txt.append(line2)
+        with open(basis_file(filep),'r') as basis:
+            line=(" "+"\n".join(map(str,[line.strip() for line in basis])))
+            line2=' '.join(line.splitlines(True))
+            txt.append(line2)
 
-        with open(filep, 'w') as outfp:
-            outfp.write('\n'.join(txt))
-            time.sleep(.5)
+        if vec is not None:
+            txt.append(vec)
+        return '\n'.join(txt)
+
+    def geometry_key(self, filep, tolerance):
+        """Identify the computation of this geometry written in filep.
+
+        Two inputs with the same key give the same energy: same charge,
+        multiplicity and basis set, same atoms with the coordinates rounded
+        to tolerance (the order of the atoms does not matter).
+
+        Args:
+            filep: (str) where the input would be written (see basis_file).
+            tolerance: (float) precision of the coordinates.
+
+        Returns:
+            (tuple) hashable key.
+        """
+        atoms = sorted((atom, round(float(x) / tolerance),
+                        round(float(y) / tolerance),
+                        round(float(z) / tolerance))
+                       for atom, x, y, z in zip(self.atoms, self.x, self.y,
+                                                self.z))
+        return (int(self.charge), int(self.multiplicity), basis_file(filep),
+                tuple(atoms))
 
     def _set_keyword_based_on_structures(self):
         self.gamess['CONTRL']['ICHARG'] = self.charge
@@ -181,6 +214,41 @@ class Input(object):
                        'SCF': dict(DIRSCF='.t.')}
 
 
+def basis_file(filep):
+    """Basis set file for the input filep (S-022 has its own basis)."""
+    m = re.search('S-022', str(filep))
+    if m is not None:
+        return '/dev/shm/afabrizi/basisS22'
+    return '/dev/shm/afabrizi/basis'
+
+
+def read_vec(punchp):
+    """Last $VEC group written in a gamess punch file (None if missing)."""
+    try:
+        with open(punchp, 'r') as punch:
+            lines = punch.read().splitlines()
+    except FileNotFoundError:
+        return None
+    start = None
+    vec = None
+    for n, line in enumerate(lines):
+        if line.strip().upper() == '$VEC':
+            start = n
+        elif start is not None and line.strip().upper() == '$END':
+            vec = lines[start:n + 1]
+            start = None
+    if vec is None or len(vec) < 3:
+        return None
+    return '\n'.join(vec)
+
+
+def vec_orbitals(vec):
+    """Number of orbitals in a $VEC group (the first line of each orbital
+    has line number 1 in columns 3-5)."""
+    return sum(1 for line in vec.splitlines()[1:-1]
+               if line[2:5].strip() == '1')
+
+
 def atnum(atom_label):
     at_num = dict(O=8,
                   H=1,
@@ -228,6 +296,60 @@ if __name__ == '__main__':
         newinput = test_read_xyz()
         newinput.write('asd.inp')
 
-    tests = [test_read_xyz, test_building_data]
+    def test_geometry_key():
+        print('**** Testing geometry_key ****')
+        xyzs = ['3\n0 1\nO 0. 0. 0.\nH 0. 0. 1.\nH 0. .7 .4\n',
+                '3\n0 1\nH 0. .7 .4\nO 0. 0. 0.\nH 0. 0. 1.\n',
+                '3\n0 1\nH 0. .7000001 .4\nO 0. 0. 0.\nH 0. 0. 1.\n',
+                '3\n0 1\nH 0. .7001 .4\nO 0. 0. 0.\nH 0. 0. 1.\n',
+                '3\n1 2\nO 0. 0. 0.\nH 0. 0. 1.\nH 0. .7 .4\n']
+        keys = []
+        for xyz in xyzs:
+            with open('test.xyz', 'w') as testxyz:
+                testxyz.write(xyz)
+            keys.append(Input('test.xyz').geometry_key('test.inp', 1E-5))
+        assert keys[0] == keys[1], 'Key depends on the order of the atoms'
+        assert keys[0] == keys[2], 'Key depends on noise below tolerance'
+        assert keys[0] != keys[3], 'Different geometries with the same key'
+        assert keys[0] != keys[4], 'Different charges with the same key'
+        assert keys[4] != Input('test.xyz').geometry_key('S-022.inp', 1E-5), \
+            'Different basis sets with the same key'
+        print('  ** Test Passed **  ')
+
+    def test_read_vec():
+        print('**** Testing read_vec and NORB ****')
+
+        def vec_group(norb, value):
+            lines = [' $VEC']
+            for orb in range(1, norb + 1):
+                for line in range(1, 3):
+                    lines.append('{:2d}{:3d}'.format(orb % 100, line) +
+                                 '{:15.8E}'.format(value) * 5)
+            lines.append(' $END')
+            return '\n'.join(lines)
+
+        with open('test.dat', 'w') as punch:
+            punch.write('\n'.join([' $DATA', ' $END', vec_group(3, 1.),
+                                   ' ENERGY', vec_group(4, 2.), '']))
+        vec = read_vec('test.dat')
+        assert vec == vec_group(4, 2.), 'The last $VEC group is not read'
+        assert vec_orbitals(vec) == 4
+        assert read_vec('missing.dat') is None
+        for xyz, scftyp, norb in [('3\n0 1\nO 0. 0. 0.\nH 0. 0. 1.\n'
+                                   'H 0. .7 .4\n', 'RHF', 4),
+                                  ('2\n0 2\nO 0. 0. 0.\nH 0. 0. 1.\n',
+                                   'UHF', 2)]:
+            with open('test.xyz', 'w') as testxyz:
+                testxyz.write(xyz)
+            newinput = Input('test.xyz')
+            txt = newinput.text('test.inp', vec)
+            assert newinput.gamess['CONTRL']['SCFTYP'] == scftyp
+            assert 'NORB={} '.format(norb) in txt, \
+                'Wrong NORB for {}'.format(scftyp)
+            assert txt.endswith(vec)
+        print('  ** Test Passed **  ')
+
+    tests = [test_read_xyz, test_building_data, test_geometry_key,
+             test_read_vec]
     for test in tests:
         test()
@@ -14,8 +14,9 @@
 
 import logging as lg
 import copy
-import re
-from utils import sum_is_one, check_list_len
+import os
+import hashlib
+from utils import sum_is_one, check_list_len, create_dir
 from config import Config
 import numpy as np
 
@@ -41,67 +42,63 @@ config = Config().config
 
 
 class Params(object):
+    """The 19 parameters of wB97X-dDsC in a single float64 array.
+
+    Every key (e.g. 'cx_aa') and sub key (e.g. 'cx_aa_1') corresponds to a
+    fixed slice of the array, so copy, comparison and difference are single
+    vector operations.
+
+    Args:
+        init: (float) the parameters are set to init, init + 1, ... in the
+            _plist order.
+    """
+
+    __slots__ = ['_values', '_copy']
+
+    _plist = ['tta', 'ttb', 'cxhf', 'omega', 'cx_aa', 'cc_aa', 'cc_ab']
+    _size = 19
+    _slices = dict(tta=slice(0, 1), ttb=slice(1, 2), cxhf=slice(2, 3),
+                   omega=slice(3, 4), cx_aa=slice(4, 9), cc_aa=slice(9, 14),
+                   cc_ab=slice(14, 19))
+    for _k in _plist[4:]:
+        for _j in range(0, 5):
+            _slices[_k + '_' + str(_j)] = \
+                slice(_slices[_k].start + _j, _slices[_k].start + _j + 1)
+    del(_k, _j)
+    _acceptable_keys = list(_slices)
 
     def __init__(self, init):
-
-        self._plist = ['tta', 'ttb', 'cxhf', 'omega', 'cx_aa', 'cc_aa',
-                       'cc_ab']
-        self._acceptable_keys = self._plist + \
-            [i + '_' + str(j) for i in self._plist[4:] for j in range(0, 5)]
-        self._prm = dict()
-        self._long_prms = re.compile(r'(\w{2}\_\w{2})(\_(\d))?')
+        self._values = np.arange(init, init + __class__._size,
+                                 dtype=np.float64)
         self._copy = False
 
-        i = init
-        for k in self._plist:
-            if self._long_prms.match(k):
-                self._prm[k] = [float(i + n) for n in range(0, 5)]
-                i += 5
-            else:
-                self._prm[k] = [float(i)]
-                i += 1
-
     def __setitem__(self, key, value):
 
-        long_ = self._long_prms.match(key)
-
         if not self._copy:
             if key == 'cxhf':
                 msg = 'Warning: You are using cxhf instead of cx_aa_1.\n'\
                     'IGNORE this message if settings default params'
                 lg.warning(msg)
 
-            if key not in self._acceptable_keys:
+            if key not in __class__._slices:
                 msg = '{} is not a valid parameters key!'.format(key)
                 lg.critical(msg)
                 raise(KeyError(msg))
 
-        if long_ and not long_.group(2):
-            if check_list_len(value, 5, key):
-                self._prm[key] = list(map(float, value))
+        slc = __class__._slices[key]
+        n = slc.stop - slc.start
+        if n == 1 and not isinstance(value, list):
+            value = [value]
+        check_list_len(value, n, key)
+        self._values[slc] = list(map(float, value))
 
-        if long_ and long_.group(2):
-            if not isinstance(value, list):
-                value = [value]
-            check_list_len(value, 1, key)
-            self._prm[long_.group(1)][int(long_.group(3))] = float(value[0])
-
-        if not long_:
-            if not isinstance(value, list):
-                value = [value]
-            if check_list_len(value, 1, key):
-                self._prm[key] = list(map(float, value))
-
-        if not self._copy and long_ and \
-            long_.group(1) == 'cx_aa': self._constr()
+        if not self._copy and key.startswith('cx_aa'): self._constr()
 
     def _constr(self):
-        if not sum_is_one(abs(self._prm['cxhf'][0]),
-                          abs(self._prm['cx_aa'][0])):
-            self._prm['cxhf'] = [1.0 - self._prm['cx_aa'][0]]
+        if not sum_is_one(abs(self._values[2]), abs(self._values[4])):
+            self._values[2] = 1.0 - self._values[4]
 
-            if not sum_is_one(abs(self._prm['cxhf'][0]),
-                              abs(self._prm['cx_aa'][0])):
+            if not sum_is_one(abs(self._values[2]), abs(self._values[4])):
                 msg = 'Hartree Exchange parameters out of boundary!'
                 lg.critical(msg)
                 raise(ValueError(msg))
@@ -113,12 +110,7 @@ class Params(object):
             lg.critical(msg)
             raise(TypeError(msg))
 
-        long_ = self._long_prms.match(key)
-
-        if long_ and long_.group(2):
-            return [self._prm[long_.group(1)][int(long_.group(3))]]
-        else:
-            return self._prm[key]
+        return self._values[__class__._slices[key]].tolist()
 
     def __missing__(self, key):
         msg = 'Implementation error: requested not existing parameter!'
@@ -126,54 +118,48 @@ class Params(object):
         raise(RuntimeError(msg))
 
     def __len__(self):
-        lenght = 0
-        for k in self._plist:
-            lenght += len(self._prm[k])
-        return lenght
+        return __class__._size
 
     def __iter__(self):
-        self._itcounter = 0
-        return self
+        return iter(self._values.tolist())
 
-    def __next__(self):
-        if self._itcounter >= len(self):
-            raise StopIteration
-        else:
-            self._itcounter += 1
-            return self.tolist()[self._itcounter - 1]
+    @property
+    def _prm(self):
+        """The parameters as a dict key: list of values."""
+        return {k: self[k] for k in __class__._plist}
 
     def __str__(self):
         return self._prm.__str__()
 
     def tolist(self):
-        list_ = []
-        for k in self._plist:
-            list_ += self._prm[k]
-        return list_
+        return self._values.tolist()
+
+    @staticmethod
+    def fromlist(values):
+        """Params with the values given by tolist (no constraint applied)."""
+        prms = Params.__new__(Params)
+        prms._values = np.array(values, dtype=np.float64)
+        prms._copy = False
+        return prms
 
     def __sub__(self, other):
         prm_res = Params(0)
-        for k in self._plist:
-            array_1 = np.array(self._prm[k])
-            array_2 = np.array(other._prm[k])
-            result = array_1 - array_2
-            prm_res._prm[k] = result.tolist()
+        np.subtract(self._values, other._values, out=prm_res._values)
         return(prm_res)
 
     def __eq__(self, other):
-        for k in self._plist:
-            array_1 = np.array(self._prm[k])
-            array_2 = np.array(other._prm[k])
-            if not np.allclose(array_1, array_2, rtol=0.0,
-                               atol=config['precision']):
-                return False
-        return True
+        return bool(np.abs(self._values - other._values).max() <=
+                    config['precision'])
+
+    def changed(self, other):
+        """Keys (in _plist) whose values differ between self and other."""
+        diff = np.abs(self._values - other._values)
+        return [k for k in __class__._plist
+                if diff[__class__._slices[k]].max() > config['precision']]
 
     def __deepcopy__(self, memo=None):
-        copy = Params(0)
-        copy._copy = True
-        for k, v in self._prm.items():
-            copy[k] = v
+        copy = Params.__new__(Params)
+        copy._values = self._values.copy()
         copy._copy = False
         return copy
 
@@ -183,6 +169,7 @@ class ParamsManager(object):
     _actual_params = Params(100)
     _old_params = Params(-100)
     _saved_params = Params(-100)
+    _materialized = {}
 
     def __init__(self):
         self._instance_params = Params(0)
@@ -193,10 +180,13 @@ class ParamsManager(object):
 
     @property
     def prms(self):
-        """Sets the actual parameters and write them on the right file.
+        """Sets the actual parameters.
 
-        Sets the parameters taking care of the constraints and writes them,
-        with the right format, on the right file.
+        Sets the parameters taking care of the constraints. The parameters
+        travel with the jobs and are written only where an external binary
+        needs them (see materialize); they are also written in
+        wb97x_params_writing and ddsc_params_writing only if
+        config['write_params_files'].
 
         Args:
             dict_: (dict) contains couples parameters: value
@@ -212,25 +202,91 @@ class ParamsManager(object):
         if save:
             __class__._saved_params = copy.deepcopy(__class__._actual_params)
 
+        if config['write_params_files']:
+            __class__.write_files(__class__._actual_params,
+                                  config['wb97x_params_writing'],
+                                  config['ddsc_params_writing'])
+
+    @staticmethod
+    def write_files(prms, wb97x_path, ddsc_path):
+        """Write the parameters in the format read by (mini-)GAMESS.
+
+        Args:
+            prms: (Params or dict) parameters to be written.
+            wb97x_path: (str) destination of the wb97x parameters file.
+            ddsc_path: (str) destination of the ddsc parameters file.
+        """
         msg = ''
-        with open(config['wb97x_params_writing'], 'w') as pf:
+        with open(wb97x_path, 'w') as pf:
             list_ = ['cxhf', 'cx_aa', 'omega', 'cc_aa', 'cc_ab']
             for k in list_:
-                for i, v in enumerate(__class__._actual_params[k]):
+                for i, v in enumerate(prms[k]):
                     msg += str(k) + str(i) + '   ' + str(v) + '\n'
             pf.write(msg)
         msg = ''
-        with open(config['ddsc_params_writing'], 'w') as pf2:
+        with open(ddsc_path, 'w') as pf2:
             list_ = ['tta', 'ttb']
             for k in list_:
-                for i, v in enumerate(__class__._actual_params[k]):
+                for i, v in enumerate(prms[k]):
                     msg += str(v) + '\n'
             pf2.write(msg)
 
+    @staticmethod
+    def key(prms):
+        """Hash of the parameter values.
+
+        Args:
+            prms: (Params or dict) parameters.
+
+        Returns:
+            (str) hex digest.
+        """
+        values = [v for k in ['tta', 'ttb', 'cxhf', 'omega', 'cx_aa',
+                              'cc_aa', 'cc_ab'] for v in prms[k]]
+        return hashlib.sha1(' '.join(map(repr, values)).encode()).hexdigest()
+
+    @staticmethod
+    def materialize(prms, dirp):
+        """Write the parameters files for an external binary in dirp.
+
+        Nothing is written if this process already wrote the same
+        parameters in dirp. The files are replaced atomically, so a binary
+        never reads half written files.
+
+        Args:
+            prms: (Params or dict) parameters.
+            dirp: (str) directory of the files.
+
+        Returns:
+            (tuple) paths of the wb97x and of the ddsc parameters files.
+        """
+        files = (os.path.join(dirp, config['wb97x_params_file']),
+                 os.path.join(dirp, config['ddsc_params_file']))
+        key = __class__.key(prms)
+        if __class__._materialized.get(dirp) != key:
+            create_dir(dirp)
+            tmp = [f + '.' + str(os.getpid()) for f in files]
+            __class__.write_files(prms, *tmp)
+            for tmpf, f in zip(tmp, files):
+                os.replace(tmpf, f)
+            __class__._materialized[dirp] = key
+        return files
+
     @prms.getter
     def prms(self, key=None):
         return __class__._actual_params
 
+    @staticmethod
+    def load_actual(prms):
+        """Replace the actual parameters without writing the files.
+
+        Used to align a process forked before the parameters changed.
+
+        Args:
+            prms: (Params) the actual parameters of the parent process.
+        """
+        __class__._actual_params = prms
+
     @property
     def prms_old(self):
         return __class__._old_params
@@ -266,6 +322,10 @@ class ParamsManager(object):
         """
         self._instance_params = copy.deepcopy(__class__._actual_params)
 
+    def restore(self, prms):
+        """Set the instance parameters (as refresh did with prms)."""
+        self._instance_params = copy.deepcopy(prms)
+
     def save(self):
         __class__._saved_params = copy.deepcopy(__class__._actual_params)
 
@@ -313,6 +373,28 @@ class Optim(object):
             dict_[p] = params[i]
         ParamsManager().prms = dict_
 
+    def to_prms(self, params):
+        """Return a copy of the actual parameters modified by params.
+
+        Unlike set_prms neither the ParamsManager nor the parameters files
+        are changed.
+
+        Args:
+            params: (list) values in the same order of the Optim obj.
+
+        Returns:
+            (Params) the new parameters.
+        """
+        if len(params) != len(self):
+            msg = 'Parameters number do not corresponds'
+            lg.critical(msg)
+            raise(RuntimeError(msg))
+
+        prms = copy.deepcopy(ParamsManager().prms)
+        for i, p in enumerate(__class__._to_optimize):
+            prms[p] = float(params[i])
+        return prms
+
 
 if __name__ == '__main__':
     from nose.tools import assert_raises
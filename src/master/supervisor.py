@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#
+# Project:  wb97xdDsC-optim
+# FileName: supervisor
+# Creation: Oct 17, 2026
+#
+
+"""Submit and harvest many SLURM full computations from a single process.
+
+With the sbatch backend each full computation holds a worker of the full Pool
+for its entire life, and the worker only sleeps waiting for the output and
+the densities. The FullSupervisor does the same work for all the molecules
+in one asyncio event loop: every job is a coroutine that submits the sbatch
+script (or finds the results in the density store) and polls, without
+blocking, the same checks the Run obj uses (see Run._readout_check and
+Run._densities_check).
+
+The submissions are spread in time as by the sbatch backend and at most
+config['processes'] are in flight together, so that command_full (often an
+ssh connection) is not flooded. A failed job does not stop the others: all
+the jobs are collected and then the failures are reported together. A job
+that exceeds the timeout is cancelled with config['command_cancel'].
+"""
+
+import shlex
+import asyncio
+import logging as lg
+from random import randint
+from utils import MAX_POLL_INTERVAL
+from backends import full_params_files
+from config import Config
+
+# Try determining the version from git:
+try:
+    import subprocess
+    git_v = subprocess.check_output(['git', 'describe'],
+                                    stderr=subprocess.DEVNULL)
+except subprocess.CalledProcessError:
+    git_v = 'Not Yet Tagged!'
+
+
+__author__ = 'Riccardo Petraglia'
+__credits__ = ['Riccardo Petraglia']
+__updated__ = "2026-10-17"
+__license__ = 'GPLv2'
+__version__ = git_v
+__maintainer__ = 'Riccardo Petraglia'
+__email__ = 'riccardo.petraglia@gmail.com'
+__status__ = 'development'
+
+config = Config().config
+
+
+async def _poll(check, max_interval, min_interval=0.5):
+    """Await until check returns something that is not None.
+
+    The time between two checks starts from min_interval and doubles up to
+    max_interval, capped at utils.MAX_POLL_INTERVAL (as utils.wait_for,
+    without watching the directory).
+    """
+    max_interval = min(max_interval, MAX_POLL_INTERVAL)
+    interval = min(min_interval, max_interval)
+    while True:
+        result = check()
+        if result is not None:
+            return result
+        await asyncio.sleep(interval)
+        interval = min(interval * 2, max_interval)
+
+
+class FullSupervisor(object):
+    """Run the full computations of many Run objs in one event loop.
+
+    Args:
+        timeout: (float) maximum time (s) for each job (None for no limit).
+
+    Attributes:
+        attempts: (int) times a failed submission is tried.
+    """
+
+    attempts = 3
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._job_ids = {}
+
+    def run(self, runs, submitted=False, landed=None):
+        """Compute the full energies of runs.
+
+        Args:
+            runs: (list) Run objs.
+            submitted: (bool) True if the jobs have already been submitted
+                (see computation.submit_array): only the results are
+                collected.
+            landed: (callable) called as landed(n, energies) as soon as the
+                job of runs[n] is done.
+
+        Returns:
+            (list) for each run the tuple (total energy, XC energy,
+            dispersion energy).
+
+        Raises:
+            RuntimeError: if some job failed (after all the others are done).
+        """
+        return asyncio.run(self._all(runs, submitted, landed))
+
+    async def _all(self, runs, submitted, landed):
+        self._semaphore = asyncio.Semaphore(config['processes'] or 1)
+        jobs = [self._timed(n, run, submitted, landed)
+                for n, run in enumerate(runs)]
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        failed = ['{}: {}'.format(run.molID, result)
+                  for run, result in zip(runs, results)
+                  if isinstance(result, BaseException)]
+        if failed:
+            msg = 'Full computation failed for:\n' + '\n'.join(failed)
+            lg.critical(msg)
+            raise(RuntimeError(msg))
+        return results
+
+    async def _timed(self, n, run, submitted, landed):
+        try:
+            energies = await asyncio.wait_for(self._job(n, run, submitted),
+                                              self.timeout)
+        except asyncio.TimeoutError:
+            await self._cancel(n, run)
+            msg = 'Full computation of {} not finished in {} s'\
+                .format(run.molID, self.timeout)
+            lg.critical(msg)
+            raise(RuntimeError(msg))
+        if landed is not None:
+            landed(n, energies)
+        return energies
+
+    async def _job(self, n, run, submitted):
+        """Full computation of one Run obj (see Run.full)."""
+        store, key, energies = run._from_store()
+        if energies is not None:
+            return energies
+        if not submitted:
+            await self._submit(n, run)
+        energies = await _poll(run._readout_check(),
+                               config['wait_for_gamess_output'])
+        if config['gamess_bin']:
+            await _poll(run._densities_check(), config['wait_to_recheck'])
+            run._keep_densities()
+        run._to_store(store, key, energies)
+        return energies
+
+    async def _submit(self, n, run):
+        """Submit the sbatch script of run (see SbatchBackend.full).
+
+        The job id given by sbatch is kept for _cancel.
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, run._write_input)
+        run._write_sbatch(full_params_files())
+        if not config['gamess_bin']:
+            return
+        run._clear_output()
+        command = shlex.split('{COMMAND:s} {SBATCH_FILE:s}'
+                              .format(COMMAND=config['command_full'],
+                                      SBATCH_FILE=run._sbatch_file))
+        await asyncio.sleep(randint(1, 10))
+        async with self._semaphore:
+            for attempt in range(1, __class__.attempts + 1):
+                lg.debug('Should run {}'.format(command))
+                proc = await asyncio.create_subprocess_exec(
+                    *command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                out, err = await proc.communicate()
+                if not proc.returncode:
+                    out = out.split()
+                    if out and out[-1].isdigit():
+                        self._job_ids[n] = out[-1].decode()
+                    return
+                lg.warning('Submission of {} failed (attempt {} of {}): {}'
+                           .format(run.molID, attempt, __class__.attempts,
+                                   err.decode().strip()))
+                await asyncio.sleep(randint(1, 10))
+        msg = 'Submission of {} failed'.format(run.molID)
+        lg.critical(msg)
+        raise(RuntimeError(msg))
+
+    async def _cancel(self, n, run):
+        """Cancel the SLURM job of run (only reported if not possible)."""
+        job_id = self._job_ids.get(n)
+        if job_id is None or not config['command_cancel']:
+            lg.warning('Job of {} (id {}) not cancelled: it may still be'
+                       ' running'.format(run.molID, job_id))
+            return
+        command = shlex.split(config['command_cancel']) + [job_id]
+        proc = await asyncio.create_subprocess_exec(
+            *command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = await proc.communicate()
+        if proc.returncode:
+            lg.warning('Job of {} (id {}) not cancelled: {}'
+                       .format(run.molID, job_id, err.decode().strip()))
+        else:
+            lg.warning('Job of {} (id {}) cancelled'.format(run.molID,
+                                                            job_id))
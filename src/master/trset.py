@@ -61,9 +61,21 @@ import params
 import logging as lg
 import os
 import copy
+import atexit
+import queue
+import time
 import multiprocessing as mproc
-from computation import Run
+from multiprocessing.pool import ThreadPool
+from computation import Run, submit_array, func_many
+from densstore import DensityStore, density_store
+from make_input import Input
+from xcengine import XCEngine
+from linmodel import LinearModel
+from functerms import FuncTerms
+from supervisor import FullSupervisor
 import itertools
+import collections
+import numpy as np
 from config import Config
 
 # Try determining the version from git:
@@ -101,16 +113,46 @@ class MolSet(object):
 
     Attributes:
         container (list): container for the loaded molecule obj.
-        to_compute (list): filters from container those molecule whose energy
-                           needs to be upgraded
+        to_compute (set): indexes of the molecules in container whose energy
+                          needs to be upgraded
+        _index (dict): id: index of the molecule in container
         _lock (bool): True if the class is computing energies in parallel
+        _func_cost (dict): index: last time (s) taken by the mini-gamess of
+                           the molecule (see _run_func_many)
+        _xc_engine (XCEngine): in-process func energies on the frozen
+                               densities (used if config['xc_engine'])
+        _pools (dict): kind: Pool used to compute that kind of energy
+        _func_memo (OrderedDict): rounded parameters: dict index: func
+                                  energy given by the mini-gamess; the
+                                  last config['func_memo_size'] parameter
+                                  vectors used (see _memo)
+        _geometries (dict): geometry key (see Input.geometry_key): id of the
+                            molecule loaded for that geometry
+        _aliases (dict): id: id of the molecule with the same geometry that
+                         is used in its place
+        geometry_tolerance (float): precision (Angstrom) used to compare
+                                    the geometries
+        _geometry_keys (dict): xyz path: geometry key already computed by
+                               the loader (see prefetch_datasets)
+        _store_keys (dict): id: (ParamsManager.key of the full parameters,
+                            density store key) of the last snapshot
 
     Todo: Implement the blacklist stuff.
     """
 
     container = []
-    to_compute = []
+    to_compute = set()
+    _index = {}
     _lock = False
+    _func_cost = {}
+    _xc_engine = None
+    _pools = {}
+    _func_memo = collections.OrderedDict()
+    _geometries = {}
+    _aliases = {}
+    geometry_tolerance = 1E-4
+    _geometry_keys = {}
+    _store_keys = {}
 
     @staticmethod
     def addto_compute(mol):
@@ -123,9 +165,7 @@ class MolSet(object):
             mol: (mol_obj) molecule to be added to the to_compute list
 
         """
-        for idx in mol:
-            if idx not in __class__.to_compute:
-                __class__.to_compute.append(idx)
+        __class__.to_compute.update(mol)
 
     @staticmethod
     def remove_compute(mol):
@@ -139,19 +179,22 @@ class MolSet(object):
 
         """
         raise(NotImplementedError)
-        for i, el in enumerate(__class__.to_compute):
-            if mol.id.strip() == el.id:
-                __class__.to_compute.pop(i)
-                msg = 'Mol: {MOL:s} popped out from the compute list'.\
-                    format(MOL=mol.id)
-                lg.debug(msg)
+        idx = __class__._index.get(mol.id.strip())
+        if idx in __class__.to_compute:
+            __class__.to_compute.discard(idx)
+            msg = 'Mol: {MOL:s} popped out from the compute list'.\
+                format(MOL=mol.id)
+            lg.debug(msg)
 
     @staticmethod
     def p_call_mol_energy(kind):
         """Start computation of energy in parallel for all the mols.
 
-        Create a Pool and start a process for each molecule who need
-        energy computation (given by the to_compute list).
+        Use the Pool of the given kind (see _get_pool) to start a job for each
+        molecule who need energy computation (given by the to_compute list).
+        Only the Run obj of the molecule and the parameters go to the Pool
+        and only the energies come back (see _energy_calc): they are stored
+        in the molecule objs of the container.
 
         Args:
             kind: (str) type of energy to compute (func = Only from XC-func, do
@@ -162,30 +205,419 @@ class MolSet(object):
             return None
         else:
             __class__.lock = True
-            tmp = [0] * len(__class__.container)
-            for i in __class__.to_compute:
-                tmp[i] = 1
-            my_pool_big = mproc.Pool(processes=config['processes'])
-            my_pool_mini = mproc.Pool(processes=config['mini_processes'])
+            tmp = __class__._compute_mask()
+            if kind == 'func' and (config['xc_engine'] or
+                                   config['func_async']):
+                __class__._fast_call_func(tmp)
+                __class__._lock = False
+                return None
+            prms = params.ParamsManager().prms
+            submitted = False
             if kind == 'full':
-                output = [my_pool_big.apply_async(mol.full_energy_calc)
-                          for mol in itertools.compress(__class__.container,
-                                                        tmp)]
-            elif kind == 'func':
-                output = [my_pool_mini.apply_async(mol.func_energy_calc)
-                          for mol in itertools.compress(__class__.container,
-                                                        tmp)]
+                todo = [i for i, mol in enumerate(__class__.container)
+                        if tmp[i] and mol.full_outdated()]
+                disp = [i for i in todo
+                        if __class__.container[i].dispersion_outdated()]
+                if disp:
+                    __class__._update_dispersion(disp)
+                    todo = [i for i in todo if i not in set(disp)]
+                if todo and config['sbatch_array'] and \
+                        config['full_backend'] in (None, 'sbatch'):
+                    __class__._submit_array(todo)
+                    submitted = True
             else:
-                msg = 'Critical error in implementation'
-                lg.critical(msg)
-                raise(RuntimeError(msg))
+                todo = [i for i, mol in enumerate(__class__.container)
+                        if tmp[i] and mol.func_outdated()]
+                memo = __class__._known_func(prms, todo)
+                for i in todo:
+                    if i in memo:
+                        __class__.container[i].set_func_energy(memo[i])
+                todo = [i for i in todo if i not in memo]
+            if not todo:  # no Pool is created if there is nothing to send
+                __class__._lock = False
+                return None
+            if kind == 'full' and config['full_supervisor'] and \
+                    config['full_backend'] in (None, 'sbatch'):
+                __class__._supervise_full(todo, prms, submitted)
+                __class__._lock = False
+                return None
+            pool = __class__._get_pool(kind)
+            if kind == 'full' and __class__._pipeline_func():
+                __class__._pipeline_full(pool, todo, prms, submitted)
+                __class__._lock = False
+                return None
+            output = [pool.apply_async(_energy_calc,
+                                       (i, __class__.container[i]._run, kind,
+                                        prms, submitted))
+                      for i in todo]
             for p in output:
-                new_mols = [p.get() for p in output]
-            __class__.refresh_container(new_mols)
-            my_pool_mini.terminate()
-            my_pool_big.terminate()
+                idx, energies = p.get()
+                if kind == 'full':
+                    __class__.container[idx].set_full_energies(*energies)
+                else:
+                    __class__.container[idx].set_func_energy(energies)
+                    __class__._record_func(prms, memo, {idx: energies})
             __class__._lock = False
 
+    @staticmethod
+    def _pipeline_func():
+        """True if the func energies are started as the full ones land.
+
+        The energies computed in advance are found by the next func
+        computations only through the memo (see _known_func): without
+        config['func_memo_size'] they would be computed twice, so the
+        pipeline is not used.
+        """
+        if not config['pipeline_func']:
+            return False
+        if not config['func_memo_size']:
+            lg.warning('pipeline_func needs func_memo_size: not used')
+            return False
+        return True
+
+    @staticmethod
+    def _pipeline_full(pool, idxs, prms, submitted):
+        """Compute the full energies and start the func ones as they land.
+
+        The full results are handled in the order they complete: as soon as
+        the density of a molecule is available its func energy with the same
+        parameters (the first point of the next optimization) is submitted to
+        the func Pool, so the cheap molecules go on while the big ones are
+        still running.
+
+        Args:
+            pool: (Pool) the full Pool.
+            idxs: (list) indexes of the molecules to compute.
+            prms: (Params) actual parameters.
+            submitted: (bool) see _energy_calc.
+        """
+        landed = queue.Queue()
+        for i in idxs:
+            pool.apply_async(_energy_calc,
+                             (i, __class__.container[i]._run, 'full', prms,
+                              submitted),
+                             callback=landed.put, error_callback=landed.put)
+        func_pool = __class__._get_pool('func')
+        output = []
+        for _ in idxs:
+            result = landed.get()
+            if isinstance(result, BaseException):
+                raise result
+            idx, energies = result
+            __class__.container[idx].set_full_energies(*energies)
+            output.append(func_pool.apply_async(
+                _energy_calc, (idx, __class__.container[idx]._run, 'func',
+                               prms)))
+        __class__._collect_func(output, prms)
+
+    @staticmethod
+    def _supervise_full(idxs, prms, submitted):
+        """Compute the full energies with the FullSupervisor (see supervisor).
+
+        The jobs are submitted and harvested by a single event loop in this
+        process instead of a worker of the full Pool each. With
+        config['pipeline_func'] the func energies are started as the full
+        ones land (see _pipeline_func and _pipeline_full).
+
+        Args:
+            idxs: (list) indexes of the molecules to compute.
+            prms: (Params) actual parameters.
+            submitted: (bool) see _energy_calc.
+        """
+        func_pool = None
+        if __class__._pipeline_func():
+            func_pool = __class__._get_pool('func')
+        output = []
+
+        def landed(n, energies):
+            idx = idxs[n]
+            __class__.container[idx].set_full_energies(*energies)
+            if func_pool is not None:
+                output.append(func_pool.apply_async(
+                    _energy_calc, (idx, __class__.container[idx]._run,
+                                   'func', prms)))
+
+        FullSupervisor(config['full_job_timeout']).run(
+            [__class__.container[i]._run for i in idxs], submitted, landed)
+        __class__._collect_func(output, prms)
+
+    @staticmethod
+    def _collect_func(output, prms):
+        """Store the func energies computed by the jobs in output."""
+        memo = __class__._memo(prms)
+        for p in output:
+            idx, energy = p.get()
+            __class__.container[idx].set_func_energy(energy)
+            __class__._record_func(prms, memo, {idx: energy})
+
+    @staticmethod
+    def _update_dispersion(idxs):
+        """Update the full energies when only tta and ttb changed.
+
+        With config['ddsc_post_scf'] the density does not depend on tta and
+        ttb: the full energy changes only by the difference of dispersion,
+        that is the difference of the func energies computed on the same
+        density with the old and the new parameters.
+
+        Args:
+            idxs: (list) indexes of the molecules (see
+                Molecule.dispersion_outdated).
+        """
+        prms = params.ParamsManager().prms
+        groups = collections.OrderedDict()
+        for i in idxs:
+            old = __class__.container[i].myprm_full.sprms
+            key = params.ParamsManager.key(old)
+            groups.setdefault(key, (old, []))[1].append(i)
+        for old, group in groups.values():
+            energies_old, energies_new = \
+                __class__._evaluate_func_many([old, prms], group)
+            for i in group:
+                __class__.container[i].update_dispersion(
+                    energies_new[i] - energies_old[i])
+        lg.debug('Full energies of {} molecules updated without SCF'
+                 .format(len(idxs)))
+
+    @staticmethod
+    def _forget_func(idxs):
+        """Remove from the memo the molecules whose density changed."""
+        for memo in __class__._func_memo.values():
+            for i in idxs:
+                memo.pop(i, None)
+
+    @staticmethod
+    def density_changed(mol):
+        """Forget the func energies of mol computed on its old density.
+
+        Called by Molecule.set_full_energies, whoever computed the new
+        density: mol is removed from the memo (see _memo) and from the
+        XCEngine.
+        """
+        idx = __class__._index.get(mol.id)
+        if idx is None:
+            return
+        __class__._forget_func([idx])
+        if __class__._xc_engine is not None:
+            __class__._xc_engine.forget([idx])
+
+    @staticmethod
+    def _known_func(prms, idxs):
+        """Func energies of idxs already known for prms.
+
+        Args:
+            prms: (Params) parameters.
+            idxs: (list) indexes of the molecules.
+
+        Returns:
+            (dict) the memo of prms (see _memo) completed with the energies
+            that the molecules can sum from their XC and dispersion terms
+            (see functerms, only with config['ddsc_post_scf']).
+        """
+        memo = __class__._memo(prms)
+        if config['ddsc_post_scf']:
+            for i in idxs:
+                if i not in memo:
+                    energy = __class__.container[i].func_terms.get(prms)
+                    if energy is not None:
+                        memo[i] = energy
+        return memo
+
+    @staticmethod
+    def _record_func(prms, memo, energies):
+        """Store the func energies computed with prms.
+
+        Args:
+            prms: (Params) parameters.
+            memo: (dict) memo of prms (see _known_func).
+            energies: (dict) index: energy given by the mini-gamess.
+        """
+        memo.update(energies)
+        if config['ddsc_post_scf']:
+            for i, energy in energies.items():
+                __class__.container[i].func_terms.add(prms, energy)
+
+    @staticmethod
+    def _memo(prms):
+        """Return the func energies already computed with prms.
+
+        The parameters are compared after rounding to config['precision'].
+        Only the last config['func_memo_size'] vectors are remembered and the
+        memo is emptied when the densities change (full computation).
+
+        Args:
+            prms: (Params) parameters.
+
+        Returns:
+            (dict) index: energy given by the mini-gamess; the computed
+            energies have to be added to it (if the memo is disabled a new
+            empty dict is returned).
+        """
+        if not config['func_memo_size']:
+            return {}
+        key = tuple(np.round(np.array(prms.tolist()) / config['precision'])
+                    .astype(np.int64).tolist())
+        memo = __class__._func_memo
+        if key in memo:
+            memo.move_to_end(key)
+        else:
+            memo[key] = {}
+            while len(memo) > config['func_memo_size']:
+                memo.popitem(last=False)
+        return memo[key]
+
+    @staticmethod
+    def _compute_mask():
+        """Return a list: 1 for the molecules in to_compute, 0 otherwise."""
+        tmp = [0] * len(__class__.container)
+        for i in __class__.to_compute:
+            tmp[i] = 1
+        return tmp
+
+    @staticmethod
+    def _submit_array(idxs):
+        """Submit in a single job array all the needed full computations.
+
+        Args:
+            idxs: (list) indexes of the molecules to compute.
+        """
+        submit_array([__class__.container[i]._run for i in idxs])
+
+    @staticmethod
+    def _get_pool(kind):
+        """Return the Pool for the given kind of energy.
+
+        The Pools are created the first time they are needed (processes
+        workers for full, mini_processes for func) and kept alive up to the
+        end of the program. Since the workers are forked only once, the
+        actual parameters are sent with each job (see _energy_calc).
+
+        Args:
+            kind: (str) "full" or "func".
+        """
+        if kind not in ['full', 'func']:
+            msg = 'Critical error in implementation'
+            lg.critical(msg)
+            raise(RuntimeError(msg))
+        if kind not in __class__._pools:
+            if kind == 'full':
+                processes = config['processes']
+            else:
+                processes = config['mini_processes']
+            __class__._pools[kind] = mproc.Pool(processes=processes)
+            atexit.register(__class__._pools[kind].terminate)
+        return __class__._pools[kind]
+
+    @staticmethod
+    def _evaluate_func(prms, idxs):
+        """Compute the mini-gamess energies for the given parameters.
+
+        See _evaluate_func_many.
+
+        Returns:
+            (dict) index: energy given by the mini-gamess.
+        """
+        return __class__._evaluate_func_many([prms], idxs)[0]
+
+    @staticmethod
+    def _evaluate_func_many(prms_list, idxs):
+        """Compute the mini-gamess energies for many parameter sets at once.
+
+        The energies already known (see _known_func) are not computed
+        again; the others are computed by _run_func_many.
+
+        Args:
+            prms_list: (list) Params objs.
+            idxs: (list) indexes of the molecules in the container.
+
+        Returns:
+            (list) one dict index: energy for each Params in prms_list.
+        """
+        memos = [__class__._known_func(prms, idxs) for prms in prms_list]
+        groups = collections.OrderedDict()
+        for n, memo in enumerate(memos):
+            missing = tuple(i for i in idxs if i not in memo)
+            if missing:
+                groups.setdefault(missing, []).append(n)
+        for missing, ns in groups.items():
+            energies = __class__._run_func_many([prms_list[n] for n in ns],
+                                                list(missing))
+            for n, energies_n in zip(ns, energies):
+                __class__._record_func(prms_list[n], memos[n], energies_n)
+        return [{i: memo[i] for i in idxs} for memo in memos]
+
+    @staticmethod
+    def _run_func_many(prms_list, idxs):
+        """Run the mini-gamess for many parameter sets at once.
+
+        Each parameter set is written in a private directory so that the
+        global parameter files are not touched and all the couples
+        (parameters, molecule) can run together. If config['func_async'] the
+        mini-gamess are launched directly from this process (see
+        computation.func_many), otherwise the func Pool is used (see
+        _get_pool): the jobs are sent longest first (by the last time taken
+        by each molecule, see _func_cost) so that the big molecules do not
+        end up alone at the end of the dispatch.
+
+        Args:
+            prms_list: (list) Params objs.
+            idxs: (list) indexes of the molecules in the container.
+
+        Returns:
+            (list) one dict index: energy for each Params in prms_list.
+        """
+        files = [params.ParamsManager.materialize(
+            prms, os.path.join(config['func_params_prefix'], 'evaluate',
+                               '{:03d}'.format(n)))
+            for n, prms in enumerate(prms_list)]
+        if config['func_async']:
+            energies = iter(func_many([(__class__.container[i]._run,) + f
+                                       for f in files for i in idxs]))
+            return [{i: next(energies) for i in idxs} for f in files]
+
+        my_pool_mini = __class__._get_pool('func')
+        cost = __class__._func_cost
+        jobs = sorted(((n, i) for n in range(len(files)) for i in idxs),
+                      key=lambda job: cost.get(job[1], 1.0), reverse=True)
+        output = [(n, i, my_pool_mini.apply_async(
+            _timed_func, (__class__.container[i]._run,) + files[n]))
+            for n, i in jobs]
+        energies = [{} for f in files]
+        for n, i, p in output:
+            energies[n][i], cost[i] = p.get()
+        return [{i: energies_n[i] for i in idxs} for energies_n in energies]
+
+    @staticmethod
+    def xc_engine():
+        """Return the XCEngine of the actual densities (create it if needed).
+
+        """
+        if __class__._xc_engine is None:
+            __class__._xc_engine = XCEngine(__class__._evaluate_func)
+        return __class__._xc_engine
+
+    @staticmethod
+    def _fast_call_func(tmp):
+        """Compute the func energies without moving the molecule objs.
+
+        The energies are computed by the XCEngine if config['xc_engine'],
+        otherwise directly by the mini-gamess (see _evaluate_func and
+        _run_func_many).
+
+        Args:
+            tmp: (list) 1 for the molecules in to_compute, 0 otherwise.
+        """
+        todo = [i for i, mol in enumerate(__class__.container)
+                if tmp[i] and mol.func_outdated()]
+        if not todo:
+            return None
+        prms = params.ParamsManager().prms
+        if config['xc_engine']:
+            energies = __class__.xc_engine().energies(prms, todo)
+        else:
+            energies = __class__._evaluate_func(prms, todo)
+        for i, energy in energies.items():
+            __class__.container[i].set_func_energy(energy)
+
     @staticmethod
     def call_mol_energy(kind):
         """Start computation of energy in serial for all the mols.
@@ -202,9 +634,7 @@ class MolSet(object):
             return None
         else:
             __class__._lock = True
-            tmp = [0] * len(__class__.container)
-            for i in __class__.to_compute:
-                tmp[i] = 1
+            tmp = __class__._compute_mask()
             for mol in itertools.compress(__class__.container, tmp):
                 if kind == 'full':
                     mol.full_energy_calc()
@@ -229,15 +659,19 @@ class MolSet(object):
             mols: (list) list of mol objs
         """
         for mol in mols:
-            obj_id = __class__.get_by_id(mol.id)
-            if obj_id is None:
-                __class__.container.append(mol)
+            idx = __class__._index.get(mol.id)
+            if idx is None:
+                __class__._append(mol)
             else:
-                for i, el in enumerate(__class__.container):
-                    if el.id == mol.id:
-                        __class__.container[i] = mol
+                __class__.container[idx] = mol
         return None
 
+    @staticmethod
+    def _append(mol):
+        """Add a new molecule obj to the container and to the index."""
+        __class__._index[mol.id] = len(__class__.container)
+        __class__.container.append(mol)
+
     @staticmethod
     def get_by_id(my_id, in_list='container'):
         """Found a molecule in the container or in the to_compute list.
@@ -253,18 +687,15 @@ class MolSet(object):
         Returns: the molecule obj if exists, None otherwise.
 
         """
-        if in_list == 'container':
-            list_ = __class__.container
-        elif in_list == 'to_compute':
-            list_ = __class__.to_compute
-        else:
+        if in_list not in ['container', 'to_compute']:
             msg = 'Critical error in implementation'
             lg.critical(msg)
             raise(RuntimeError(msg))
 
-        for el in list_:
-            if my_id.strip() == el.id:
-                return el
+        idx = __class__._index.get(my_id.strip())
+        if idx is not None and \
+                (in_list == 'container' or idx in __class__.to_compute):
+            return __class__.container[idx]
         msg = 'Molecule ++{}++ not found!'.format(my_id.strip())
         lg.warning(msg)
         return None
@@ -279,19 +710,17 @@ class MolSet(object):
         Args:
             mols: (list) of strings that should match the ID of the molecules.
         """
-        poss = []
-        for mol in mols:
-            for i, el in enumerate(__class__.container):
-                if mol.id == el.id:
-                    poss.append(i)
-        return poss
+        return [__class__._index[mol.id] for mol in mols
+                if mol.id in __class__._index]
 
     @staticmethod
     def load_molecules(names, dsetp):
         """Load a requested molecule and store it in the container.
 
         To avoid charging more than once the same molecule the method check if
-        the molecule is already loaded and if not, loads it.
+        the molecule is already loaded and if not, loads it. The same geometry
+        (with the same charge, multiplicity and basis) in different datasets
+        is loaded only once: the first molecule obj is used for all of them.
 
         Args:
             names (list): name of the molecule to be loaded.
@@ -303,17 +732,203 @@ class MolSet(object):
         dset_name = os.path.basename(dsetp)
         for name in names:
             my_id = '{}.{}'.format(dset_name, name)
-            obj = __class__.get_by_id(my_id)
-            if obj is not None:
+            my_id = __class__._aliases.get(my_id, my_id)
+            if my_id in __class__._index:
+                obj = __class__.container[__class__._index[my_id]]
                 needed_mol.append(obj)
                 lg.debug('Molecule {} already existing'.format(my_id))
-            else:
-                mol = Molecule(os.path.join(dsetp, 'geometry', name + '.xyz'))
-                needed_mol.append(mol)
-                __class__.container.append(mol)
+                continue
+            xyzp = os.path.join(dsetp, 'geometry', name + '.xyz')
+            key = __class__._geometry_keys.pop(xyzp, None)
+            if key is None:
+                key = _geometry_key(xyzp, dsetp)
+            if key in __class__._geometries:
+                obj = __class__.container[
+                    __class__._index[__class__._geometries[key]]]
+                __class__._aliases[my_id] = obj.id
+                needed_mol.append(obj)
+                lg.info('Molecule {} has the same geometry of {}'
+                        .format(my_id, obj.id))
+                continue
+            mol = Molecule(xyzp)
+            __class__._geometries[key] = mol.id
+            needed_mol.append(mol)
+            __class__._append(mol)
 
         return needed_mol
 
+    @staticmethod
+    def prefetch_datasets(dsetps):
+        """Read the rule.dat files and the geometries of many datasets.
+
+        The files are read by a ThreadPool (config['processes'] threads) and
+        the geometry keys of the molecules not loaded yet are kept for
+        load_molecules, so that building the objs needs no file access.
+
+        Args:
+            dsetps: (list) paths to the dataset directories.
+
+        Returns:
+            (dict) dataset path: lines of its rule.dat.
+        """
+        with ThreadPool(config['processes']) as pool:
+            rules = dict(zip(dsetps, pool.map(_read_rules, dsetps)))
+            todo = []
+            for dsetp in dsetps:
+                dset_name = os.path.basename(dsetp)
+                for line in rules[dsetp]:
+                    data = line.split()
+                    for name in data[1:int((len(data) - 2) / 2 + 1)]:
+                        my_id = '{}.{}'.format(dset_name, name)
+                        if __class__._aliases.get(my_id, my_id) \
+                                not in __class__._index:
+                            todo.append((os.path.join(dsetp, 'geometry',
+                                                      name + '.xyz'), dsetp))
+            todo = list(collections.OrderedDict.fromkeys(todo))
+            keys = pool.starmap(_geometry_key, todo)
+        __class__._geometry_keys.update(zip((x[0] for x in todo), keys))
+        return rules
+
+    @staticmethod
+    def snapshot():
+        """State of the computed molecules (see checkpoint).
+
+        Returns:
+            (dict) molecules: for each molecule id with a full energy the
+            energies, the parameters they were computed with and (if the
+            density store is used) the key of its density in the store;
+            func_memo: the memo of the func energies (see _memo) by
+            molecule id.
+
+            The store keys are computed (reading the geometry and the basis
+            set) only when the full parameters of the molecule changed since
+            the last snapshot, i.e. once per density cycle.
+        """
+        store = density_store()
+        molecules = {}
+        for mol in __class__.container:
+            if not mol._full_energy:
+                continue
+            entry = dict(full=[mol._full_energy, mol._full_exc,
+                               mol._full_disp],
+                         uni=mol._uni_energy,
+                         full_prms=mol.myprm_full.sprms.tolist())
+            if mol._func_energy is not None:
+                entry['func'] = mol._func_energy - mol._uni_energy
+                entry['func_prms'] = mol.myprm_func.sprms.tolist()
+            if store is not None:
+                entry['store_key'] = __class__._store_key(mol)
+            molecules[mol.id] = entry
+        func_memo = [[list(key), {__class__.container[i].id: energy
+                                  for i, energy in memo.items()}]
+                     for key, memo in __class__._func_memo.items()]
+        return dict(molecules=molecules, func_memo=func_memo)
+
+    @staticmethod
+    def _store_key(mol):
+        """Density store key of the full computation of mol (see snapshot)."""
+        prms_key = params.ParamsManager.key(mol.myprm_full.sprms)
+        cached = __class__._store_keys.get(mol.id)
+        if cached is None or cached[0] != prms_key:
+            cached = (prms_key, DensityStore.key(
+                Input(mol._run._xyzp).text(mol._run._inout_inp_path),
+                mol.myprm_full.sprms))
+            __class__._store_keys[mol.id] = cached
+        return cached[1]
+
+    @staticmethod
+    def restore(state):
+        """Restore the molecules of the container saved by snapshot.
+
+        A molecule is restored only if its density is in densities_repo or
+        can be taken from the density store; otherwise it will be computed
+        again.
+
+        Args:
+            state: (dict) as given by snapshot.
+
+        Returns:
+            (int) number of molecules restored.
+        """
+        store = density_store()
+        restored = {}
+        for my_id, entry in state['molecules'].items():
+            idx = __class__._index.get(__class__._aliases.get(my_id, my_id))
+            if idx is None:
+                continue
+            mol = __class__.container[idx]
+            run = mol._run
+            if not (os.path.isfile(run._wb97x_saves) and
+                    os.path.isfile(run._ddsc_saves)):
+                key = entry.get('store_key')
+                if store is None or key is None or \
+                        store.get(key, run._wb97x_saves,
+                                  run._ddsc_saves) is None:
+                    lg.warning('Density of {} not found: it will be computed'
+                               ' again'.format(my_id))
+                    continue
+            mol._full_energy, mol._full_exc, mol._full_disp = entry['full']
+            mol._uni_energy = entry['uni']
+            mol.myprm_full.restore(params.Params.fromlist(entry['full_prms']))
+            mol.func_terms.clear()
+            if 'func' in entry:
+                mol._func_energy = entry['func'] + mol._uni_energy
+                mol.myprm_func.restore(
+                    params.Params.fromlist(entry['func_prms']))
+            restored[my_id] = idx
+        __class__._xc_engine = None
+        for key, energies in state['func_memo']:
+            memo = {restored[my_id]: energy
+                    for my_id, energy in energies.items()
+                    if my_id in restored}
+            if memo:
+                __class__._func_memo[tuple(key)] = memo
+        lg.info('{} molecules restored from the checkpoint'
+                .format(len(restored)))
+        return len(restored)
+
+
+def _read_rules(dsetp):
+    """Lines of the rule.dat file of a dataset (without comments)."""
+    with open(os.path.join(dsetp, 'rule.dat')) as rulef:
+        return [line for line in rulef if line.split()[0][0] != '#']
+
+
+def _geometry_key(xyzp, dsetp):
+    """Geometry key of a molecule (see Input.geometry_key)."""
+    return Input(xyzp).geometry_key(dsetp, MolSet.geometry_tolerance)
+
+
+def _timed_func(run, wb97x_param, ddsc_param):
+    """Job of _run_func_many: func energy and time (s) it took."""
+    start = time.time()
+    return run.func(wb97x_param, ddsc_param), time.time() - start
+
+
+def _energy_calc(idx, run, kind, prms, submitted=False):
+    """Job executed by the MolSet Pools.
+
+    The Pool processes live longer than a single set of parameters, so the
+    actual parameters of the parent are set before computing the energy.
+
+    Args:
+        idx: (int) index of the molecule in MolSet.container.
+        run: (Run) Run obj of the molecule.
+        kind: (str) "full" or "func".
+        prms: (Params) actual parameters of the parent process.
+        submitted: (bool) see Molecule.full_energy_calc.
+
+    Returns:
+        (tuple) idx and the energies: the tuple given by Run.full for full,
+        the mini-gamess energy for func.
+    """
+    params.ParamsManager.load_actual(prms)
+    if kind == 'full':
+        if submitted:
+            return idx, run.collect_full()
+        return idx, run.full()
+    return idx, run.func()
+
 
 class Molecule(object):
     """Create a molecule object starting from an xyz file.
@@ -339,17 +954,28 @@ class Molecule(object):
 
     """
     def __init__(self, path):
-        lg.debug('Importing Molecule from \n{}\n'.format(path))
+        if lg.getLogger().isEnabledFor(lg.DEBUG):
+            lg.debug('Importing Molecule from \n{}\n'.format(path))
         self.id = None  # If none there is some problem!
         self.xyzp = os.path.abspath(path)
         self.belonging_dataset = None
         self.myprm_full = params.ParamsManager()
         self.myprm_func = params.ParamsManager()
         self._full_energy = None
+        self._full_exc = None
+        self._full_disp = None
         self._uni_energy = None
         self._func_energy = None
+        self.func_terms = FuncTerms()
         self._molecule_creator()
-        self._run = Run(molID=self.id, dset=self.belonging_dataset)
+        self._run_obj = None
+
+    @property
+    def _run(self):
+        """Run obj of the molecule (created, with its dirs, when needed)."""
+        if self._run_obj is None:
+            self._run_obj = Run(molID=self.id, dset=self.belonging_dataset)
+        return self._run_obj
 
     def __str__(self):
         """Return a human readable string when the object is printed.
@@ -369,6 +995,8 @@ class Molecule(object):
         self.name = file[:-4]
         self.id = '{DATASET:s}.{NAME:s}'.format(DATASET=self.belonging_dataset,
                                                 NAME=self.name)
+        if not lg.getLogger().isEnabledFor(lg.DEBUG):
+            return
         lg.debug("""Molecule Information:
          * Dataset: {DATASET:s}
          * Name: {NAME:s}
@@ -421,13 +1049,33 @@ class Molecule(object):
         self.func_energy_calc()
         return self._func_energy
 
-    def full_energy_calc(self):
+    def full_outdated(self):
+        """True if the full energy has to be computed (again)."""
+        return not self._full_energy or not self.myprm_full.check_prms()
+
+    def dispersion_outdated(self):
+        """True if only the dispersion of the full energy is outdated.
+
+        That is when the full energy is outdated only because tta or ttb
+        changed and dDsC is a post-SCF correction (config['ddsc_post_scf']).
+        """
+        if not config['ddsc_post_scf'] or not self._full_energy or \
+                self._full_disp is None:
+            return False
+        changed = self.myprm_full.prms.changed(self.myprm_full.sprms)
+        return bool(changed) and set(changed) <= {'tta', 'ttb'}
+
+    def full_energy_calc(self, submitted=False):
         """Retrieve the energy at fulldft level.
 
         Check if the parameters are changed from the last computation and in
         that case compute the fulldft energy from scratch, otherwise will
         return the last computed energy.
 
+        Args:
+            submitted: (bool) True if the job has already been submitted
+                (e.g. in a job array): only its results are collected.
+
         Returns:
             self
         """
@@ -436,19 +1084,47 @@ class Molecule(object):
                  .format(str(self._full_energy),
                          str(self.myprm_full.check_prms())))
 
-        if not self._full_energy or not self.myprm_full.check_prms():
-            full_energy, full_exc, full_disp = self._run.full()
-            uni_energy = full_energy - full_exc - full_disp
-            lg.debug('Full Energy for {ID:s} is {ENERGY:12.6f}'
-                     ' and UNIENERGY is{UNIENERGY:12.6f}'
-                     .format(ID=self.id, ENERGY=full_energy,
-                             UNIENERGY=uni_energy))
-            self._full_energy = full_energy
-            self._uni_energy = uni_energy
-            self.myprm_full.refresh()
+        if self.full_outdated():
+            if submitted:
+                self.set_full_energies(*self._run.collect_full())
+            else:
+                self.set_full_energies(*self._run.full())
 
         return self
 
+    def set_full_energies(self, full_energy, full_exc, full_disp):
+        """Store the energies of a full computation with the actual parameters.
+
+        Args:
+            full_energy: (float) total energy.
+            full_exc: (float) XC energy.
+            full_disp: (float) dispersion energy.
+        """
+        uni_energy = full_energy - full_exc - full_disp
+        lg.debug('Full Energy for {ID:s} is {ENERGY:12.6f}'
+                 ' and UNIENERGY is{UNIENERGY:12.6f}'
+                 .format(ID=self.id, ENERGY=full_energy,
+                         UNIENERGY=uni_energy))
+        self._full_energy = full_energy
+        self._full_exc = full_exc
+        self._full_disp = full_disp
+        self._uni_energy = uni_energy
+        self.func_terms.clear()
+        self.myprm_full.refresh()
+        MolSet.density_changed(self)
+
+    def update_dispersion(self, delta):
+        """Change the dispersion of the full energy (same density).
+
+        Args:
+            delta: (float) new - old dispersion energy.
+        """
+        self._full_energy += delta
+        self._full_disp += delta
+        lg.debug('Full Energy for {ID:s} is {ENERGY:12.6f} (dispersion'
+                 ' updated)'.format(ID=self.id, ENERGY=self._full_energy))
+        self.myprm_full.refresh()
+
     def func_energy_calc(self):
         """Retrieve the energy computed with the optimized density.
 
@@ -460,27 +1136,43 @@ class Molecule(object):
             self
         """
 
-        if self._uni_energy is None:
-            msg = 'UNIENERGY NOT DEFINED'
-            lg.critical(msg)
-            raise(ValueError(msg))
         lg.debug('Func Energy for {ID:s} started'.format(ID=self.id))
         lg.debug('Check if needed: Energy -> {:s}, CheckPar -> {:s}'
                  .format(str(self._full_energy),
                          str(self.myprm_func.check_prms())))
-        if not self._func_energy or not self.myprm_func.check_prms():
-            func_energy = self._run.func()
-            lg.debug('Func Energy for {ID:s} is {ENERGY:12.6f}'
-                     .format(ID=self.id, ENERGY=func_energy))
-
-            self.myprm_func.refresh()
-            if not isinstance(self._uni_energy, float):
-                msg = 'UniEnergy is not a float for {MOLID:s}!'\
-                      .format(MOLID=self.id)
-                raise(RuntimeError(msg))
-            self._func_energy = func_energy + self._uni_energy
+        if self.func_outdated():
+            self.set_func_energy(self._run.func())
         return self
 
+    def func_outdated(self):
+        """True if the func energy has to be computed (again).
+
+        Raises:
+            ValueError: if the full energy has never been computed.
+        """
+        if self._uni_energy is None:
+            msg = 'UNIENERGY NOT DEFINED'
+            lg.critical(msg)
+            raise(ValueError(msg))
+        return not self._func_energy or not self.myprm_func.check_prms()
+
+    def set_func_energy(self, func_energy):
+        """Store the func energy computed with the actual parameters.
+
+        Args:
+            func_energy: (float) energy as given by the mini-gamess (the
+                uni energy is added here).
+        """
+        lg.debug('Func Energy for {ID:s} is {ENERGY:12.6f}'
+                 .format(ID=self.id, ENERGY=func_energy))
+
+        self.myprm_func.refresh()
+        if not isinstance(self._uni_energy, float):
+            msg = 'UniEnergy is not a float for {MOLID:s}!'\
+                  .format(MOLID=self.id)
+            raise(RuntimeError(msg))
+        self._func_energy = func_energy + self._uni_energy
+
 
 class System(object):
     """Provides the System object: a set of molecules, a rule and a reference.
@@ -517,7 +1209,9 @@ class System(object):
     """
 
     def __init__(self, rule_line, dsetp):
-        lg.debug('Initializing System from line: \n{}\n'.format(rule_line))
+        if lg.getLogger().isEnabledFor(lg.DEBUG):
+            lg.debug('Initializing System from line: \n{}\n'
+                     .format(rule_line))
         self.dsetp = os.path.abspath(dsetp)
         self.belonging_dataset = None
         self.id = 'None'
@@ -556,6 +1250,8 @@ class System(object):
             lg.critical(msg)
             raise(TypeError(msg))
 
+        if not lg.getLogger().isEnabledFor(lg.DEBUG):
+            return
         lg.debug("""System Information:
          * Dataset: {DATASET:2}
          * Name: {NAME:s}
@@ -862,20 +1558,25 @@ class DataSet(Set):
         path: (str) path to the dataset directory (see System class docstring
             for a description of the rule file and see the example directory to
             check how the datasat tree has to be.
+        rules: (list) lines of the rule file already read (see
+            MolSet.prefetch_datasets); if None the rule file is read.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, rules=None):
         lg.debug('Initializing DataSet from {}'.format(path))
         super().__init__(path)
-        self._set_creator()
+        self._set_creator(rules)
 
-    def _set_creator(self):
+    def _set_creator(self, rules=None):
         """Takes care of most of the work to set the attributes.
 
         Since the creation of the instance needs to take care of many things I
         created this method even if, actually, all the stuff inside could have
         been done directly by the init method.
 
+        Args:
+            rules: (list) see the class docstring.
+
         Attributes:
             name: (str) the name of the root directory of the dataset
             id: (str) the same a the name (directory path must be unique!)
@@ -884,11 +1585,9 @@ class DataSet(Set):
         """
         self.name = os.path.basename(self.path)
         self.id = self.name
-        with open(os.path.join(self.path, 'rule.dat')) as rulef:
-            rulec = rulef.readlines()
-        for line in rulec:
-            if line.split()[0][0] == '#':
-                continue
+        if rules is None:
+            rules = _read_rules(self.path)
+        for line in rules:
             self.container.append(System(line, self.path))
         lg.debug("""DataSet Information:
          * Name: {NAME:s}
@@ -977,6 +1676,7 @@ class TrainingSet(Set):
         super().__init__(path)
         self.name = file[:-4]
         self.filep = os.path.join(self.path, file.strip())
+        self._linear_model = None
         self._set_creator()
 
     def _set_creator(self):
@@ -1002,12 +1702,15 @@ class TrainingSet(Set):
         self._blacklistp = os.path.join(self.path, self.name + '-blacklist.dat')
         self._fulldftlistp = os.path.join(self.path,
                                           self.name + '-fulldftlist.dat')
+        dsetps = []
         with open(self.filep, 'r') as filec:
             for line in filec:
                 if line.split()[0][0] == '#':
                     continue
-                dsetp = os.path.join(self.path, line.strip())
-                self.container.append(DataSet(dsetp))
+                dsetps.append(os.path.join(self.path, line.strip()))
+        rules = MolSet.prefetch_datasets(dsetps)
+        for dsetp in dsetps:
+            self.container.append(DataSet(dsetp, rules[dsetp]))
         self.read_allist()
 
     def _read_list(self, listp):
@@ -1118,5 +1821,116 @@ class TrainingSet(Set):
         if kind == 'full':
             params.ParamsManager().save()
 
+        if kind == 'func' and config['linear_model']:
+            self._MAE = self.linear_model().MAE_prms(
+                params.ParamsManager().prms)
+            return self._MAE
+
         MolSet.p_call_mol_energy(kind)
         return super().compute_MAE(kind)
+
+    def compute_MAE_grad(self, kind, optim):
+        """Compute the func MAE and its gradient for the actual parameters.
+
+        Analytic for the XC coefficients, finite differences for the others
+        (see LinearModel.MAE_grad_prms).
+
+        Args:
+            kind: (str) only "func" is implemented.
+            optim: (Optim) the parameters of the gradient (in that order).
+
+        Returns:
+            (float, np.array) MAE and gradient.
+        """
+        if kind != 'func':
+            msg = 'Gradient available only for func MAE!'
+            lg.critical(msg)
+            raise(NotImplementedError(msg))
+        self._MAE, grad = self.linear_model().MAE_grad_prms(
+            params.ParamsManager().prms, list(optim),
+            MolSet._evaluate_func_many)
+        return self._MAE, grad
+
+    def compute_MAE_batch(self, kind, vectors, optim):
+        """Compute the func MAE for many parameter vectors in one dispatch.
+
+        The actual parameters (ParamsManager) are not changed: each vector is
+        applied to a copy of them (see Optim.to_prms). The fulldftlisted
+        systems keep the error they have with the actual parameters.
+
+        Args:
+            kind: (str) only "func" is implemented.
+            vectors: (list) parameter vectors (same order of optim).
+            optim: (Optim) meaning of the elements of the vectors.
+
+        Returns:
+            (list) MAE for each vector.
+        """
+        if kind != 'func':
+            msg = 'Batch evaluation available only for func MAE!'
+            lg.critical(msg)
+            raise(NotImplementedError(msg))
+        if self._linear_model is None:
+            self._linear_model = LinearModel(self)
+        model = self._linear_model
+        prms_list = [optim.to_prms(v) for v in vectors]
+        energies = MolSet._evaluate_func_many(prms_list, model.mols)
+        return model.MAE_energies(energies, MolSet.container)
+
+    def compute_MAE_fd_grad(self, kind, optim, params_, eps=1E-8):
+        """Compute the MAE and its forward finite difference gradient.
+
+        The len(optim) + 1 points are evaluated in a single dispatch (see
+        compute_MAE_batch). Unlike the differences taken by scipy through
+        compute_MAE, the fulldftlisted systems are kept constant (no full
+        computation at the displaced points): used only with
+        config['fd_grad'].
+
+        Args:
+            kind: (str) only "func" is implemented.
+            optim: (Optim) parameters of the gradient.
+            params_: (list) point where the gradient is computed.
+            eps: (float) step (the default of scipy L-BFGS-B).
+
+        Returns:
+            (float, np.array) MAE and gradient.
+        """
+        vectors = [list(map(float, params_))]
+        steps = []
+        for n in range(len(optim)):
+            step = eps
+            vector = list(vectors[0])
+            vector[n] += step
+            try:
+                optim.to_prms(vector)
+            except ValueError:
+                # out of the constraint (cx_aa_0 + cxhf = 1): step back
+                step = -eps
+                vector[n] -= 2 * eps
+            vectors.append(vector)
+            steps.append(step)
+        maes = self.compute_MAE_batch(kind, vectors, optim)
+        self._MAE = maes[0]
+        grad = [(mae - maes[0]) / step for mae, step in zip(maes[1:], steps)]
+        return self._MAE, np.array(grad)
+
+    def linear_model(self):
+        """Return the LinearModel of the func errors for the actual densities.
+
+        The model is built once and its A and b are recomputed only when the
+        XCEngine changes (new densities, omega, tta or ttb).
+
+        Returns:
+            (LinearModel) ready to be used with the actual parameters.
+        """
+        if self._linear_model is None:
+            self._linear_model = LinearModel(self)
+        for i in self._linear_model.mols:
+            if MolSet.container[i]._uni_energy is None:
+                msg = 'UNIENERGY NOT DEFINED'
+                lg.critical(msg)
+                raise(ValueError(msg))
+        engine = MolSet.xc_engine()
+        engine.prepare(params.ParamsManager().prms, self._linear_model.mols)
+        self._linear_model.update(engine, MolSet.container)
+        return self._linear_model
@@ -13,11 +13,19 @@
 
 import os
 import mmap
+import time
+import select
+import ctypes
+import ctypes.util
 import logging as lg
 from config import Config
 
 config = Config().config
 
+# Files written by the cluster nodes on NFS are not notified by inotify:
+# wait_for never waits longer than this between two checks.
+MAX_POLL_INTERVAL = 5.0
+
 # Try determining the version from git:
 try:
     import subprocess
@@ -75,9 +83,12 @@ def find_in_file(filep, strings_, reverse=False):
     elif isinstance(strings_, str):
         if returnNone:
             return [None]
-        result = s.find(strings_)
-        s.seek(result)
-        found_line.append(s.readline())
+        result = s.find(strings_.encode())
+        if result != -1:
+            s.seek(result)
+            found_line.append(s.readline())
+        else:
+            found_line.append(None)
     else:
         msg = 'The second argument can be a string or a list of strings'
         raise ValueError(msg)
@@ -85,6 +96,61 @@ def find_in_file(filep, strings_, reverse=False):
     return found_line
 
 
+class LogFollower(object):
+    """Look for strings in a growing file reading every byte only once.
+
+    The equivalent of find_in_file(filep, strings_, reverse=True) for a file
+    that is still being written: each update reads only what has been
+    appended (up to the last complete line) since the previous one.
+
+    Args:
+        filep: (str) path of the file (it does not need to exist yet).
+        strings_: (list) bytes to look for.
+
+    Attributes:
+        found: (list) for each string the last occurrence, from the string to
+            the end of its line (as find_in_file), or None.
+    """
+
+    def __init__(self, filep, strings_):
+        self.filep = filep
+        self.strings = list(strings_)
+        self.found = [None] * len(self.strings)
+        self._offset = 0
+
+    def update(self):
+        """Scan the new complete lines of the file.
+
+        If the file is shorter than what has already been read it is assumed
+        to be a new file and it is read from the beginning.
+
+        Returns:
+            (list) the found attribute.
+        """
+        try:
+            f = open(self.filep, 'rb')
+        except FileNotFoundError:
+            return self.found
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self._offset:
+                self.found = [None] * len(self.strings)
+                self._offset = 0
+            if size == self._offset:
+                return self.found
+            f.seek(self._offset)
+            data = f.read(size - self._offset)
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            return self.found
+        for n, string_ in enumerate(self.strings):
+            pos = data.rfind(string_, 0, end)
+            if pos != -1:
+                self.found[n] = data[pos:data.find(b'\n', pos) + 1]
+        self._offset += end
+        return self.found
+
+
 def create_dir(path):
     check_path = os.path.exists(path) and not os.path.isdir(path)
     check_path_dir = os.path.exists(path) and os.path.isdir(path)
@@ -110,3 +176,148 @@ def check_list_len(value, n, prm):
         lg.critical(msg)
         raise (TypeError(msg))
     return True
+
+
+class DirWatcher(object):
+    """Wait for something to be written in a directory.
+
+    On Linux inotify is used: the wait ends as soon as a file in the directory
+    is created, written or moved in. Files written by other machines (e.g. a
+    cluster node writing on NFS) are not notified, so the wait always ends
+    after the given timeout as well. If inotify is not available the wait is
+    a simple sleep.
+
+    Args:
+        dirp: (str) path of the directory to watch.
+    """
+
+    # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    _mask = 0x002 | 0x008 | 0x080 | 0x100
+
+    def __init__(self, dirp):
+        self._fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK)
+        except (OSError, AttributeError, TypeError):
+            return
+        if fd < 0:
+            return
+        if libc.inotify_add_watch(fd, os.fsencode(dirp), __class__._mask) < 0:
+            os.close(fd)
+            return
+        self._fd = fd
+
+    def wait(self, timeout):
+        """Wait for an event or for timeout seconds.
+
+        Returns:
+            (bool) True if something has been written.
+        """
+        if self._fd is None:
+            time.sleep(timeout)
+            return False
+        ready = select.select([self._fd], [], [], timeout)[0]
+        if not ready:
+            return False
+        try:
+            while os.read(self._fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def wait_for(check, dirp, max_interval, min_interval=0.5):
+    """Call check until it returns something that is not None.
+
+    check is called as soon as something is written in dirp (see DirWatcher)
+    or after a timeout that starts from min_interval and doubles at each
+    unsuccessful wait up to max_interval (at most MAX_POLL_INTERVAL).
+
+    Args:
+        check: (callable) without arguments.
+        dirp: (str) directory where the awaited files are written.
+        max_interval: (float) maximum time (s) between two checks.
+        min_interval: (float) first time (s) between two checks.
+
+    Returns:
+        The first result of check that is not None.
+    """
+    max_interval = min(max_interval, MAX_POLL_INTERVAL)
+    interval = min(min_interval, max_interval)
+    watcher = DirWatcher(dirp)
+    try:
+        while True:
+            result = check()
+            if result is not None:
+                return result
+            if not watcher.wait(interval):
+                interval = min(interval * 2, max_interval)
+    finally:
+        watcher.close()
+
+
+if __name__ == '__main__':
+    import tempfile
+    import threading
+
+    tmpdir = tempfile.mkdtemp()
+    logp = os.path.join(tmpdir, 'test.log')
+    strings_ = [b'FINAL ENERGY', b'Final Energy']
+
+    print('Checking LogFollower:')
+    follower = LogFollower(logp, strings_)
+    assert follower.update() == [None, None], 'Missing file not handled'
+    with open(logp, 'w') as f:
+        f.write(' FINAL ENERGY -1.0\n Final Ener')
+    assert follower.update() == [b'FINAL ENERGY -1.0\n', None]
+    with open(logp, 'a') as f:
+        f.write('gy -2.0\n FINAL ENERGY -3.0\n')
+    assert follower.update() == [b'FINAL ENERGY -3.0\n',
+                                 b'Final Energy -2.0\n'], \
+        'Appended lines not read'
+    assert follower.update() == [b'FINAL ENERGY -3.0\n',
+                                 b'Final Energy -2.0\n'], \
+        'Nothing appended: the results have to be the same'
+    print('...Done\n')
+
+    print('Checking LogFollower truncation:')
+    with open(logp, 'w') as f:
+        f.write(' Final Energy -4.0\n')
+    assert follower.update() == [None, b'Final Energy -4.0\n'], \
+        'A shorter file has to be read from the beginning'
+    print('...Done\n')
+
+    print('Checking DirWatcher:')
+    watcher = DirWatcher(tmpdir)
+    start = time.time()
+    assert not watcher.wait(0.2), 'Nothing written: no event expected'
+    assert time.time() - start >= 0.2
+    threading.Timer(0.2, lambda: open(os.path.join(tmpdir, 'new'),
+                                      'w').close()).start()
+    start = time.time()
+    notified = watcher.wait(2)
+    if watcher._fd is not None:
+        assert notified and time.time() - start < 2, 'Event not notified'
+    watcher.close()
+    print('...Done\n')
+
+    print('Checking wait_for:')
+    calls = []
+
+    def check():
+        calls.append(1)
+        return len(calls) if len(calls) == 3 else None
+    assert wait_for(check, tmpdir, 100, 0.01) == 3
+    assert MAX_POLL_INTERVAL < 100
+    print('...Done\n')
+
+    for name in os.listdir(tmpdir):
+        os.remove(os.path.join(tmpdir, name))
+    os.rmdir(tmpdir)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#
+# Project:  wb97xdDsC-optim
+# FileName: xcengine
+# Creation: Oct 17, 2026
+#
+
+"""In-process re-evaluation of the func energies on frozen densities.
+
+For a fixed density the wB97X XC energy is a sum over the grid of the B97
+power series: each cx_aa, cc_aa and cc_ab coefficient multiplies a quantity
+(the integral of the corresponding term of the series) that depends only on the
+density and on omega. The func energy of a molecule is then:
+
+    E(p) = offset(omega, tta, ttb) + moments(omega) . c(p)
+
+where c(p) are the 15 linear coefficients. The layout of the PARAM_UNF.dat dump
+is private to the mini-gamess, so the engine does not integrate the grid
+itself: it gets the 15 moments of every molecule asking the mini-gamess the
+energy in 16 points once for each density. After that the energies of all
+the molecules, for as many parameter vectors as needed, are a single matrix
+product.
+
+Since cxhf is constrained to 1 - cx_aa_0 the Hartree-Fock exchange is part of
+the cx_aa_0 moment.
+"""
+
+import copy
+import logging as lg
+import numpy as np
+from config import Config
+
+# Try determining the version from git:
+try:
+    import subprocess
+    git_v = subprocess.check_output(['git', 'describe'],
+                                    stderr=subprocess.DEVNULL)
+except subprocess.CalledProcessError:
+    git_v = 'Not Yet Tagged!'
+
+
+__author__ = 'Riccardo Petraglia'
+__credits__ = ['Riccardo Petraglia']
+__updated__ = "2026-10-17"
+__license__ = 'GPLv2'
+__version__ = git_v
+__maintainer__ = 'Riccardo Petraglia'
+__email__ = 'riccardo.petraglia@gmail.com'
+__status__ = 'development'
+
+config = Config().config
+
+LINEAR = [k + '_' + str(i) for k in ['cx_aa', 'cc_aa', 'cc_ab']
+          for i in range(0, 5)]
+
+
+def linear_vector(prms):
+    """Return the linear coefficients of prms as an array (LINEAR order)."""
+    return np.array([prms[k][0] for k in LINEAR], dtype=np.float64)
+
+
+class XCEngine(object):
+    """Func energies of many molecules as a matrix product.
+
+    Args:
+        evaluate: (callable) evaluate(prms, idxs) has to return a dict
+            index: energy computed by the mini-gamess for the molecules idxs
+            with the parameters prms.
+
+    Attributes:
+        step: (float) displacement used to get the moments.
+        tolerance: (float) max error (Hartree) accepted in the linearity check.
+        rows: (dict) index of the molecule in MolSet.container: row in the
+            arrays.
+        moments: (np.array) n_molecules x 15.
+        offset: (np.array) n_molecules.
+        generation: (int) changes every time moments or offset change (unique
+            among all the engines).
+    """
+
+    step = 0.1
+    tolerance = 1E-6
+    _counter = 0
+
+    def __init__(self, evaluate):
+        self._evaluate = evaluate
+        self.rows = {}
+        self.moments = np.zeros((0, len(LINEAR)))
+        self.offset = np.zeros(0)
+        self._omega = None
+        self._disp = None
+        self._new_generation()
+
+    def _new_generation(self):
+        __class__._counter += 1
+        self.generation = __class__._counter
+
+    def _nonlinear(self, prms):
+        return prms['omega'][0], (prms['tta'][0], prms['ttb'][0])
+
+    def _probe(self, prms, idxs):
+        """Compute moments and offsets of idxs around prms.
+
+        Returns:
+            (np.array, np.array) moments and offsets in the order of idxs.
+        """
+        c0 = linear_vector(prms)
+        e0 = self._evaluate(prms, idxs)
+        e0 = np.array([e0[i] for i in idxs])
+        moments = np.zeros((len(idxs), len(LINEAR)))
+        for k, key in enumerate(LINEAR):
+            step = __class__.step
+            # cx_aa_0 has to stay in [0, 1] (see Params._constr)
+            if key == 'cx_aa_0' and c0[k] + step > 1.0:
+                step = -step
+            prms_k = copy.deepcopy(prms)
+            prms_k[key] = c0[k] + step
+            ek = self._evaluate(prms_k, idxs)
+            moments[:, k] = (np.array([ek[i] for i in idxs]) - e0) / step
+        offset = e0 - moments.dot(c0)
+
+        # Linearity check: all the coefficients displaced together by half a
+        # step (at a full step the secants above fit any separable curvature)
+        prms_t = copy.deepcopy(prms)
+        for k, key in enumerate(LINEAR):
+            if key != 'cx_aa_0':
+                prms_t[key] = c0[k] + 0.5 * __class__.step
+        et = self._evaluate(prms_t, idxs)
+        et = np.array([et[i] for i in idxs])
+        error = np.abs(et - offset - moments.dot(linear_vector(prms_t)))
+        if error.size and error.max() > __class__.tolerance:
+            msg = 'Func energy not linear in the XC coefficients '\
+                  '(max error {:e}): XCEngine cannot be used!'\
+                  .format(error.max())
+            lg.critical(msg)
+            raise(RuntimeError(msg))
+        return moments, offset
+
+    def prepare(self, prms, idxs):
+        """Make the engine able to compute idxs with prms.
+
+        New molecules are probed; if omega changed all the molecules are
+        probed again; if only tta or ttb changed the offsets are recomputed
+        with one mini-gamess call per molecule.
+
+        Args:
+            prms: (Params) parameters that will be used.
+            idxs: (list) indexes of the molecules that will be computed.
+        """
+        omega, disp = self._nonlinear(prms)
+        if self._omega is not None and \
+                abs(omega - self._omega) > config['precision']:
+            lg.info('omega changed: XCEngine rebuilt')
+            self.__init__(self._evaluate)
+
+        new = [i for i in idxs if i not in self.rows]
+        if self._disp is not None and \
+                max(abs(a - b) for a, b in zip(disp, self._disp)) > \
+                config['precision']:
+            old = list(self.rows)
+            energies = self._evaluate(prms, old)
+            energies = np.array([energies[i] for i in old])
+            rows = [self.rows[i] for i in old]
+            self.offset[rows] = energies - \
+                self.moments[rows].dot(linear_vector(prms))
+            self._new_generation()
+            lg.debug('XCEngine offsets recomputed for tta, ttb = {}'
+                     .format(disp))
+
+        if new:
+            lg.debug('XCEngine probing {} molecules'.format(len(new)))
+            moments, offset = self._probe(prms, new)
+            for i in new:
+                self.rows[i] = len(self.rows)
+            self.moments = np.vstack((self.moments, moments))
+            self.offset = np.concatenate((self.offset, offset))
+            self._new_generation()
+
+        self._omega = omega
+        self._disp = disp
+
+    def forget(self, idxs):
+        """Remove the molecules idxs (their density changed).
+
+        They will be probed again by the next prepare.
+        """
+        idxs = [i for i in idxs if i in self.rows]
+        if not idxs:
+            return
+        drop = set(self.rows[i] for i in idxs)
+        keep = [r for r in range(len(self.offset)) if r not in drop]
+        self.moments = self.moments[keep]
+        self.offset = self.offset[keep]
+        old = sorted((r, i) for i, r in self.rows.items() if r not in drop)
+        self.rows = {i: n for n, (r, i) in enumerate(old)}
+        self._new_generation()
+
+    def energy_matrix(self, vectors, idxs):
+        """Func energies for many vectors of linear coefficients.
+
+        Args:
+            vectors: (np.array) n_vectors x 15 coefficients (LINEAR order).
+            idxs: (list) indexes of the molecules.
+
+        Returns:
+            (np.array) n_vectors x len(idxs) energies.
+        """
+        rows = [self.rows[i] for i in idxs]
+        vectors = np.atleast_2d(vectors)
+        return vectors.dot(self.moments[rows].T) + self.offset[rows]
+
+    def energies(self, prms, idxs):
+        """Func energies for the given parameters.
+
+        Returns:
+            (dict) index: energy (as the mini-gamess would give it).
+        """
+        self.prepare(prms, idxs)
+        result = self.energy_matrix(linear_vector(prms), idxs)[0]
+        return dict(zip(idxs, result.tolist()))
+
+
+if __name__ == '__main__':
+    import params
+
+    Config.set('precision', 1E-8)
+    rng = np.random.RandomState(0)
+    true_moments = rng.uniform(-1, 1, (4, len(LINEAR)))
+    true_offset = rng.uniform(-100, -10, 4)
+
+    def fake_evaluate(prms, idxs):
+        c = linear_vector(prms)
+        return {i: true_offset[i] + prms['tta'][0] + true_moments[i].dot(c)
+                for i in idxs}
+
+    def fake_nonlinear(prms, idxs):
+        energies = fake_evaluate(prms, idxs)
+        return {i: e + prms['cc_aa_1'][0]**2 for i, e in energies.items()}
+
+    prms = params.Params.fromlist([1.0, 1.0, 0.158, 0.3, 0.842, 0.726, 1.044,
+                                   -6.9, 6.6, 1.0, -4.3, 22.2, -51.7, 28.2,
+                                   1.0, 0.7, -4.4, 3.1, -0.0])
+
+    print('Checking moments and offset:')
+    engine = XCEngine(fake_evaluate)
+    energies = engine.energies(prms, [0, 1, 2])
+    assert engine.rows == {0: 0, 1: 1, 2: 2}
+    assert np.allclose(engine.moments, true_moments[:3])
+    assert np.allclose(engine.offset, true_offset[:3] + 1.0)
+    new = copy.deepcopy(prms)
+    new['cc_ab_2'] = -2.0
+    expected = fake_evaluate(new, [0, 1, 2, 3])
+    energies = engine.energies(new, [0, 1, 2, 3])
+    assert all(abs(energies[i] - expected[i]) < 1E-8 for i in expected)
+    print('...Done\n')
+
+    print('Checking tta, ttb and omega changes:')
+    generation = engine.generation
+    new['tta'] = 3.0
+    energies = engine.energies(new, [0, 1, 2, 3])
+    expected = fake_evaluate(new, [0, 1, 2, 3])
+    assert all(abs(energies[i] - expected[i]) < 1E-8 for i in expected)
+    assert engine.generation != generation, 'Offsets not recomputed'
+    new['omega'] = 0.4
+    engine.prepare(new, [1])
+    assert list(engine.rows) == [1], 'Engine not rebuilt for a new omega'
+    print('...Done\n')
+
+    print('Checking forget:')
+    engine.prepare(new, [0, 1, 2, 3])
+    engine.forget([0, 2, 5])
+    assert engine.rows == {1: 0, 3: 1}, 'Rows not renumbered'
+    assert np.allclose(engine.moments, true_moments[[1, 3]])
+    energies = engine.energies(new, [0, 1, 2, 3])
+    expected = fake_evaluate(new, [0, 1, 2, 3])
+    assert all(abs(energies[i] - expected[i]) < 1E-8 for i in expected)
+    print('...Done\n')
+
+    print('Checking linearity check:')
+    try:
+        XCEngine(fake_nonlinear).prepare(prms, [0, 1])
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('Non linear energies accepted')
+    print('...Done\n')